@@ -11,7 +11,7 @@ import scanpy as sc
 import networkx as nx
 
 from utils import load_global_PPI, read_ts_data, count_cells_per_celltype
-from utils import calculate_correlation
+from utils import calculate_correlation, write_edgelist
 
 import sys
 sys.path.insert(0, '..') # add data_config to path
@@ -133,14 +133,14 @@ def read_ppi(f):
     return ppi_layers
 
 
-def write_ppi_edgelists(ppi_layers, output_f):
+def write_ppi_edgelists(ppi_layers, output_f, compression = ""):
     saved_edgelists = []
     for celltype, ppi in ppi_layers.items():
-        output_edgelist_f = output_f + "_".join(celltype.split(" ")) + ".txt"
+        output_edgelist_f = output_f + "_".join(celltype.split(" ")) + ".txt" + compression
         assert " " not in output_edgelist_f
         assert output_edgelist_f not in saved_edgelists
         print("Writing to...", output_edgelist_f)
-        nx.write_edgelist(ppi, output_edgelist_f, data = False)
+        write_edgelist(ppi, output_edgelist_f, data = False)
         saved_edgelists.append(output_edgelist_f)
     print("Finished writing %d edgelists." % len(saved_edgelists))
 
@@ -164,6 +164,7 @@ def main():
     parser.add_argument("-max_pval", type=float, default=1, help="Maximum p-value threshold for ranked genes.")
     parser.add_argument("-max_num_genes", type=int, default=4000, help="Maximum number of genes to keep (pre-LCC).")
     parser.add_argument("-celltype_ppi_filename", type=str, default=OUTPUT_DIR + "ppi_TabulaSapiens", help="Filename (prefix) of cell type specific PPI.")
+    parser.add_argument("-compression", type=str, default="", choices=["", ".gz", ".zst"], help="Compress the cell type specific PPI edgelists (suffix appended to .txt).")
     args = parser.parse_args()
 
     # Read global PPI
@@ -213,7 +214,7 @@ def main():
             extract_celltype_ppi(args.rank_pval_filename + ".csv", args.celltype_ppi_filename + "_maxpval", ppi, lcc = True, max_pval = args.max_pval, max_number_of_genes = args.max_num_genes)
 
         ppi_layers = read_ppi(args.celltype_ppi_filename + ("_maxpval=%s.csv" % str(args.max_pval)))
-        write_ppi_edgelists(ppi_layers, OUTPUT_DIR)
+        write_ppi_edgelists(ppi_layers, OUTPUT_DIR, args.compression)
 
     print("All finished!")
     
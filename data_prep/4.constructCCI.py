@@ -5,6 +5,8 @@ from collections import defaultdict
 import pandas as pd
 import networkx as nx
 
+from utils import write_edgelist
+
 
 def parse_cpdb_output(f, cluster_adj, pvalue, cutoff):
     df = pd.read_csv(f, sep="\t")
@@ -51,7 +53,7 @@ def main():
 
     parser = argparse.ArgumentParser(description="Extracting cell-cell interactions.")
     parser.add_argument("-cpdb_output", type=str, help="Directory of output files from CellPhoneDB.")
-    parser.add_argument("-cci_edgelist", type=str, help="Filename of cell-cell interaction network.")
+    parser.add_argument("-cci_edgelist", type=str, help="Filename of cell-cell interaction network (compressed if it ends in .gz or .zst).")
     parser.add_argument("-threshold", type=float, help="Minimum number of iterations for a cell-cell interaction to be significant.")
     args = parser.parse_args()
 
@@ -60,7 +62,7 @@ def main():
     cci = generate_cci(cpdb_files)
     G = count_majority(cci, len(cpdb_files), args.threshold)
 
-    nx.write_edgelist(G, args.cci_edgelist, data = False, delimiter = "\t")
+    write_edgelist(G, args.cci_edgelist, data = False, delimiter = "\t")
 
 
 if __name__ == "__main__":
@@ -4,7 +4,7 @@ import pandas as pd
 import networkx as nx
 import obonet
 
-from utils import load_celltype_ppi
+from utils import load_celltype_ppi, read_edgelist, write_edgelist
 
 import sys
 sys.path.insert(0, '..') # add data_config to path
@@ -12,7 +12,7 @@ from data_config import BTO_DIR, OUTPUT_DIR
 
 
 def filter_cci(cci_f, celltype_ppi):
-    cci = nx.read_edgelist(cci_f, delimiter = "\t", create_using = nx.MultiGraph)
+    cci = read_edgelist(cci_f, delimiter = "\t", create_using = nx.MultiGraph)
     print(nx.info(cci))
 
     celltypes = [c[1] for c in celltype_ppi]
@@ -91,7 +91,7 @@ def main():
     parser.add_argument("-celltype_ppi", type=str, help="Filename (prefix) of cell type PPI.")
     parser.add_argument("-annotation", type=str, default="cell_ontology_class", help="Column for cell type annotation.")
     parser.add_argument("-cci_edgelist", type=str, help="Filename of cell-cell interaction network.")
-    parser.add_argument("-mg_edgelist", type=str, help="Filename of meta graph.")
+    parser.add_argument("-mg_edgelist", type=str, help="Filename of meta graph (compressed if it ends in .gz or .zst).")
     args = parser.parse_args()
 
     # Read cell type PPI networks
@@ -122,7 +122,7 @@ def main():
     print("New meta graph (checking that it's the same as the meta graph):\n", nx.info(new_metagraph))
     
     # Save
-    nx.write_edgelist(metagraph, args.mg_edgelist, data = False, delimiter = "\t")
+    write_edgelist(metagraph, args.mg_edgelist, data = False, delimiter = "\t")
 
 
 if __name__ == "__main__":
@@ -12,6 +12,20 @@ import scanpy as sc
 import networkx as nx
 import obonet
 
+import sys
+sys.path.insert(0, '..') # add pinnacle to path
+from pinnacle.edgelist_reader import open_edgelist # Edge lists ending in .gz or .zst are (de)compressed on the fly
+
+
+def read_edgelist(f, **kwargs):
+    with open_edgelist(f, "rt") as fin:
+        return nx.read_edgelist(fin, **kwargs)
+
+
+def write_edgelist(G, f, **kwargs):
+    with open_edgelist(f, "wb") as fout:
+        nx.write_edgelist(G, fout, **kwargs)
+
 
 def read_ts_data(f):
     ts_data = sc.read_h5ad(f)
@@ -34,7 +48,7 @@ def get_dendrogram(ts_data):
 
 
 def load_global_PPI(f):
-    G = nx.read_edgelist(f)
+    G = read_edgelist(f)
     print("Number of nodes:", len(G.nodes))
     print("Number of edges:", len(G.edges))
     return G
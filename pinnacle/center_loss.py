@@ -23,12 +23,13 @@ class CenterLoss(nn.Module):
         #else:
         #    self.centers = nn.Parameter(torch.randn(self.num_classes, self.feat_dim))
 
-    def forward(self, x, centers, labels):
+    def forward(self, x, centers, labels, weights=None):
         """
         Args:
             x: feature matrix with shape (batch_size, feat_dim).
             centers: class embeddings (num_classes, feat_dim).
             labels: ground truth labels with shape (batch_size).
+            weights: optional sample weights with shape (batch_size); the loss is then the weighted mean over samples.
         """
         batch_size = x.size(0)
         distmat = torch.pow(x, 2).sum(dim=1, keepdim=True).expand(batch_size, self.num_classes) + \
@@ -41,6 +42,7 @@ class CenterLoss(nn.Module):
         mask = labels.eq(classes.expand(batch_size, self.num_classes))
 
         dist = distmat * mask.float()
-        loss = dist.clamp(min=1e-12, max=1e+12).sum() / batch_size
+        if weights is None: loss = dist.clamp(min=1e-12, max=1e+12).sum() / batch_size
+        else: loss = (dist.clamp(min=1e-12, max=1e+12) * weights.unsqueeze(1)).sum() / weights.sum()
 
         return loss
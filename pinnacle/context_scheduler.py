@@ -0,0 +1,74 @@
+"""
+Per-step sampling of the contexts (cell type specific PPI layers) that are trained in a step, so that step time depends on the number of contexts per step rather than on the size of the atlas.
+"""
+import math
+import threading
+import torch
+
+
+STRATEGIES = ["uniform", "size", "loss"]
+
+
+class ContextScheduler:
+    """
+    Draws the contexts of every training step. Contexts that were not trained in the last :code:`window` steps are always included (with weight 1). The remaining :code:`k` minus (overdue contexts) draws (at least one) are multinomial over the other contexts, with probabilities that are uniform, proportional to the context size, or proportional to the running link prediction loss of the context. A drawn context is weighted by its number of draws / (draws * probability), so the weighted sum of the link prediction losses of a step is an unbiased estimate of the sum over all contexts.
+
+    :param keys: Contexts (cell type keys).
+    :param k: Number of draws per step (a step can have fewer contexts if a context is drawn more than once, or more if more contexts are overdue).
+    :param strategy: Sampling probabilities (:code:`uniform`, :code:`size`, or :code:`loss`).
+    :param sizes: Dictionary of contexts to their size (e.g., number of train edges), for :code:`size`.
+    :param window: Every context is trained at least once every :code:`window` steps (default: :code:`2 * ceil(len(keys) / k)`).
+    :param momentum: Momentum of the running loss of every context, for :code:`loss`.
+
+    Draws and updates are serialized by a lock, as the contexts of a step are drawn by the thread sampling its batches (e.g., :class:`BatchPrefetcher`), while the losses are observed by the training loop. With prefetching, draws thus see the losses of the steps up to the prefetch depth before.
+    """
+    def __init__(self, keys: list, k: int, strategy: str = "uniform", sizes: dict = None, window: int = 0, momentum: float = 0.9):
+        assert strategy in STRATEGIES, "Unknown context sampling strategy %s" % strategy
+        self.keys = list(keys)
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self.k = min(k, len(self.keys))
+        self.strategy = strategy
+        self.window = window if window > 0 else 2 * math.ceil(len(self.keys) / self.k)
+        assert self.window * self.k >= len(self.keys), "A window of %d steps with %d contexts per step cannot cover %d contexts" % (self.window, self.k, len(self.keys))
+        self.sizes = torch.tensor([float(sizes[key]) for key in self.keys]) if strategy == "size" else None
+        self.momentum = momentum
+        self.running_loss = torch.ones(len(self.keys))
+        self.last_seen = torch.full((len(self.keys),), -1, dtype=torch.long)
+        self.step = 0
+        self.lock = threading.Lock()
+
+    def probabilities(self) -> torch.Tensor:
+        if self.strategy == "size": weights = self.sizes
+        elif self.strategy == "loss": weights = self.running_loss
+        else: weights = torch.ones(len(self.keys))
+        return weights / weights.sum()
+
+    def draw(self) -> tuple:
+        """
+        :return: Contexts of the next step, and the weight of every context's link prediction loss.
+        """
+        with self.lock:
+            return self._draw()
+
+    def _draw(self) -> tuple:
+        overdue = self.step - self.last_seen >= self.window
+        weights = overdue.float()
+        draws = max(self.k - int(overdue.sum()), 1) # At least one draw, so that the estimate covers the contexts that are not overdue
+        if not overdue.all():
+            p = self.probabilities() * (~overdue)
+            p = p / p.sum()
+            counts = torch.bincount(torch.multinomial(p, draws, replacement=True), minlength=len(self.keys)).float()
+            weights += torch.where(counts > 0, counts / (draws * p), torch.zeros_like(p))
+        chosen = torch.nonzero(weights > 0).view(-1)
+        self.last_seen[chosen] = self.step
+        self.step += 1
+        return [self.keys[i] for i in chosen.tolist()], weights[chosen]
+
+    def observe(self, keys: list, losses: torch.Tensor):
+        """
+        Update the running loss of the trained contexts (for :code:`loss`).
+        """
+        idx = torch.tensor([self.index[key] for key in keys], dtype=torch.long)
+        losses = losses.detach().float().cpu()
+        with self.lock:
+            self.running_loss[idx] = self.momentum * self.running_loss[idx] + (1 - self.momentum) * losses
@@ -1,12 +1,209 @@
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from scipy.linalg import solve_triangular
 from torch_geometric.nn import GATv2Conv
 from torch_geometric.nn.inits import glorot, zeros
+from torch_geometric.utils import remove_self_loops, softmax
+
+try:
+    import pyg_lib
+except ImportError: # Only needed for the fused grouped projection
+    pyg_lib = None
+
+
+def bucketed_matmul(x, sizes, weight):
+    """
+    Segment matrix multiplication as batched matrix multiplications: segments are bucketed by the power of two above their size, and the segments of a bucket are padded to its largest one and multiplied with one :code:`torch.bmm` (at most twice the rows of the segments, and one multiplication per bucket instead of one per segment).
+
+    :param x: Rows of all segments (N, in_channels), segment after segment.
+    :param sizes: Number of rows of every segment (tensor).
+    :param weight: Weight of every segment (S, in_channels, out_channels).
+
+    :return: :code:`x` multiplied by the weight of its segment (N, out_channels).
+    """
+    if x.shape[0] == 0: return x.new_zeros(0, weight.shape[-1])
+    segment = torch.repeat_interleave(torch.arange(len(sizes), device=x.device), sizes)
+    pos = torch.arange(x.shape[0], device=x.device) - (torch.cumsum(sizes, 0) - sizes)[segment] # Row within its segment
+    bucket = torch.ceil(torch.log2(sizes.clamp(min=1).double())).long()
+    rows, out = [], []
+    for b in torch.unique(bucket[sizes > 0]).tolist():
+        members = torch.nonzero(bucket == b).view(-1)
+        rank = torch.full_like(sizes, -1)
+        rank[members] = torch.arange(len(members), device=x.device)
+        row = torch.nonzero(rank[segment] >= 0).view(-1)
+        index = (rank[segment[row]], pos[row])
+        padded = x.new_zeros(len(members), int(sizes[members].max()), x.shape[1]).index_put(index, x[row])
+        rows.append(row)
+        out.append(torch.bmm(padded, weight[members])[index])
+    return torch.cat(out)[torch.argsort(torch.cat(rows))]
+
+
+class GroupedGATv2Conv(nn.Module):
+    """
+    GATv2 convolutions of several graphs with separate weights (one :class:`GATv2Conv` with default options per group), run together. The weights of group :code:`g` are slices :code:`[g]` of stacked tensors. The nodes of all graphs are projected with a segment matrix multiplication over the packed rows (see :code:`project`). Messages are passed over the disjoint union of the graphs' edges, with self-loops on every node, as in :class:`GATv2Conv`.
+    """
+    def __init__(self, num_groups, in_channels, out_channels, heads=1, negative_slope=0.2):
+        super().__init__()
+        self.num_groups = num_groups
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.heads = heads
+        self.negative_slope = negative_slope
+
+        # Source (l) and target (r) projections of every group, stacked along the output dimension
+        self.weight = nn.Parameter(torch.Tensor(num_groups, in_channels, 2 * heads * out_channels))
+        self.lin_bias = nn.Parameter(torch.Tensor(num_groups, 2 * heads * out_channels))
+        self.att = nn.Parameter(torch.Tensor(num_groups, heads, out_channels))
+        self.bias = nn.Parameter(torch.Tensor(num_groups, heads * out_channels))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        HC = self.heads * self.out_channels
+        glorot(self.weight[:, :, :HC])
+        glorot(self.weight[:, :, HC:])
+        zeros(self.lin_bias)
+        glorot(self.att)
+        zeros(self.bias)
+
+    @classmethod
+    def from_modules(cls, convs):
+        """
+        Stack the weights of a list of :class:`GATv2Conv` (e.g., the :code:`ppi_w` of models saved before grouped execution). Group :code:`g` computes the same output as :code:`convs[g]`.
+        """
+        conv = convs[0]
+        grouped = cls(len(convs), conv.in_channels, conv.out_channels, conv.heads, conv.negative_slope)
+        with torch.no_grad():
+            grouped.weight.copy_(torch.stack([torch.cat([c.lin_l.weight, c.lin_r.weight]).t() for c in convs]))
+            grouped.lin_bias.copy_(torch.stack([torch.cat([c.lin_l.bias, c.lin_r.bias]) for c in convs]))
+            grouped.att.copy_(torch.cat([c.att for c in convs]))
+            grouped.bias.copy_(torch.stack([c.bias for c in convs]))
+        return grouped.to(conv.att.device)
+
+    def project(self, x, sizes, groups):
+        """
+        Project the nodes of every graph with the weights of its group. The nodes of a graph are contiguous, so this is a segment matrix multiplication over the packed rows (:code:`pyg_lib.ops.segment_matmul` if available, otherwise :code:`bucketed_matmul`).
+
+        :param x: Packed node features of all graphs (N, in_channels).
+        :param sizes: Number of nodes of every graph.
+        :param groups: Group (weight slice) of every graph.
+
+        :return: Source and target projections (N, heads, out_channels).
+        """
+        groups = torch.as_tensor(groups, dtype=torch.long, device=x.device)
+        sizes_t = torch.tensor(sizes, dtype=torch.long, device=x.device)
+        weight = self.weight[groups]
+        if pyg_lib is not None:
+            ptr = torch.cat([sizes_t.new_zeros(1), torch.cumsum(sizes_t, 0)])
+            out = pyg_lib.ops.segment_matmul(x, ptr, weight)
+        else:
+            out = bucketed_matmul(x, sizes_t, weight)
+        out = out + self.lin_bias[torch.repeat_interleave(groups, sizes_t)]
+        x_l, x_r = out.view(-1, 2, self.heads, self.out_channels).unbind(1)
+        return x_l, x_r
+
+    def propagate(self, x_l, x_r, edge_index, node_group):
+        """
+        :param edge_index: Packed edges of all graphs (2, E), over the packed nodes.
+        :param node_group: Group of every node (N,).
+
+        :return: Output of every node (N, heads * out_channels).
+        """
+        num_nodes = x_l.shape[0]
+        edge_index, _ = remove_self_loops(edge_index)
+        loops = torch.arange(num_nodes, device=edge_index.device)
+        src = torch.cat([edge_index[0], loops])
+        dst = torch.cat([edge_index[1], loops])
+        x_j = x_l[src]
+        x = F.leaky_relu(x_r[dst] + x_j, self.negative_slope)
+        alpha = (x * self.att[node_group[dst]]).sum(dim=-1)
+        alpha = softmax(alpha, dst, num_nodes=num_nodes)
+        out = torch.zeros_like(x_l).index_add_(0, dst, x_j * alpha.unsqueeze(-1))
+        return out.view(num_nodes, -1) + self.bias[node_group]
+
+
+def grouped_metapath_forward(ppi_x, ppi_metapaths, conv, W, b, q):
+    """
+    Metapath GATv2 and semantic attention of all cell types at once (node-level attention of every metapath, then semantic attention over the metapaths). Metapaths without edges in a cell type are masked out of its semantic attention.
+
+    :return: Dictionary of cell types to their node embeddings (views of one packed tensor).
+    """
+    keys = list(ppi_x.keys())
+    sizes = [ppi_x[key].shape[0] for key in keys]
+    x = torch.cat([ppi_x[key] for key in keys])
+    offsets = [0]
+    for n in sizes[:-1]: offsets.append(offsets[-1] + n)
+    node_group = torch.repeat_interleave(torch.tensor(keys, dtype=torch.long, device=x.device), torch.tensor(sizes, dtype=torch.long, device=x.device))
+    node_graph = torch.repeat_interleave(torch.arange(len(keys), device=x.device), torch.tensor(sizes, dtype=torch.long, device=x.device))
+    x_l, x_r = conv.project(x, sizes, keys)
+
+    # Node-level attention of every metapath (metapath m of all cell types in one pass)
+    out, valid = [], []
+    for m in range(max(len(ppi_metapaths[key]) for key in keys)):
+        has_edges = [len(ppi_metapaths[key]) > m and ppi_metapaths[key][m].shape[1] > 0 for key in keys]
+        if not any(has_edges): continue
+        edge_index = torch.cat([ppi_metapaths[key][m].to(x.device) + offset for key, offset, has in zip(keys, offsets, has_edges) if has], dim=1)
+        out.append(conv.propagate(x_l, x_r, edge_index, node_group))
+        valid.append(torch.tensor(has_edges, device=x.device)[node_graph])
+    out = torch.stack(out, dim=1)
+    valid = torch.stack(valid, dim=1)
+
+    # Apply non-linearity
+    out = F.leaky_relu(out) * valid.unsqueeze(-1)
+
+    # Aggregate node-level representation using semantic level attention
+    w = torch.sum(W * out.unsqueeze(-1), dim=-2) + b
+    w = torch.tanh(w)
+    beta = torch.sum(q * w, dim=-1).masked_fill(~valid, float("-inf"))
+    beta = torch.softmax(beta, dim=1).nan_to_num(0.0) # Nodes of cell types without any metapath edges
+    z = torch.sum(out * beta.unsqueeze(-1), dim=1)
+    return dict(zip(keys, torch.split(z, sizes)))
+
+
+def convert_ppi_convs(model) -> bool:
+    """
+    Replace the per-cell type :class:`GATv2Conv` lists (:code:`ppi_w`) of a model saved before grouped execution by :class:`GroupedGATv2Conv`.
+
+    :return: Whether any module was converted (the parameters of the model changed, so optimizers need to be rebuilt).
+    """
+    converted = False
+    for module in model.modules():
+        if isinstance(module, (PCTConv, PPIConv)) and isinstance(module.ppi_w, nn.ModuleList):
+            module.ppi_w = GroupedGATv2Conv.from_modules(module.ppi_w)
+            converted = True
+    return converted
+
+
+TISSUE_CHECK_EVERY = 10 # Sweeps between convergence checks of the tissue updates (each check synchronizes with the device)
+
+
+def tissue_operator(tissue_neighbors, num_nodes, sweeps, device):
+    """
+    Linear operator of :code:`sweeps` sequential updates of the tissue embeddings. A sweep visits the tissues in sorted order and sets each to the mean of its neighbors' current embeddings, so tissues earlier in the order contribute their value of the same sweep (Gauss-Seidel). With :code:`L` the part of the row-normalized tissue adjacency :code:`P` on earlier tissues, a sweep maps :code:`x_T` to :code:`(I - L)^-1 (P - L) x`; the sweeps compose into one (num tissues, num_nodes) matrix, built once in float64.
+
+    :return: Tissue node indices, and the dense operator (tissue embeddings after the sweeps are :code:`op @ x`).
+    """
+    tissues = sorted(tissue_neighbors)
+    P = np.zeros((len(tissues), num_nodes))
+    for i, t in enumerate(tissues):
+        assert len(tissue_neighbors[t]) != 0
+        np.add.at(P[i], np.asarray(tissue_neighbors[t], dtype=np.int64), 1.0 / len(tissue_neighbors[t]))
+    L = np.tril(P[:, tissues], -1) # Tissues updated earlier in the same sweep
+    R = P.copy()
+    R[:, tissues] -= L
+    sweep = solve_triangular(np.eye(len(tissues)) - L, R, lower=True, unit_diagonal=True)
+    sweep_T = sweep[:, tissues].copy()
+    sweep[:, tissues] = 0 # Contribution of the nodes that are not updated (cell types)
+    op = np.zeros_like(P)
+    op[:, tissues] = np.eye(len(tissues))
+    for _ in range(sweeps):
+        op = sweep_T @ op + sweep
+    return torch.tensor(tissues, dtype=torch.long, device=device), torch.tensor(op, dtype=torch.float, device=device)
 
 
 class PCTConv(nn.Module):
-    def __init__(self, in_channels, num_ppi_relations, num_mg_relations, ppi_data, out_channels, sem_att_channels, pc_att_channels, node_heads=3, tissue_update = 100):
+    def __init__(self, in_channels, num_ppi_relations, num_mg_relations, ppi_data, out_channels, sem_att_channels, pc_att_channels, node_heads=3, tissue_update = 100, tissue_tol = 0.0):
         super().__init__()
         
         self.ppi_data = ppi_data
@@ -17,15 +214,16 @@ class PCTConv(nn.Module):
         self.sem_att_channels = sem_att_channels
         self.node_heads = node_heads
         self.tissue_update = tissue_update
-        self.tissue_update = 100
+        self.tissue_tol = tissue_tol # Stop the tissue updates early once no tissue embedding changes by more than this (0: always run tissue_update updates)
 
         # Cell-type specific PPI weights
         self.ppi_attn = dict()
 
-        # Independent GAT per cell type specific PPI network
-        self.ppi_w = torch.nn.ModuleList()
-        for celltype, ppi in ppi_data.items():
-            self.ppi_w.append(GATv2Conv(in_channels, out_channels, node_heads))
+        # Last pooled PPI embedding of every cell type (detached), used for cell types that are not in a batch
+        self.pooled = dict()
+
+        # Independent GAT per cell type specific PPI network (run together)
+        self.ppi_w = GroupedGATv2Conv(len(ppi_data), in_channels, out_channels, node_heads)
 
         # Independent GAT for metagraph
         self.mg_conv_in = GATv2Conv(in_channels, out_channels, node_heads)
@@ -54,6 +252,11 @@ class PCTConv(nn.Module):
         zeros(self.b)
         glorot(self.q)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pooled"] = dict() # Training state: not pickled into checkpoints or copied by deepcopy
+        return state
+
     def _per_data_forward(self, x, edgetypes, node_conv):
 
         # Calculate node-level attention representations
@@ -71,16 +274,34 @@ class PCTConv(nn.Module):
         z = torch.sum(out * beta.unsqueeze(-1), dim=1)
         return z
 
+    def _update_tissues(self, mg_x, tissue_neighbors):
+        """
+        Set every tissue embedding to the mean of its neighbors' embeddings, one tissue at a time in sorted order, :code:`tissue_update` times (one matrix multiplication with the composed operator, see :code:`tissue_operator`). With :code:`tissue_tol`, the sweeps run in chunks of :code:`TISSUE_CHECK_EVERY` (one multiplication each), and stop after the first chunk in which no tissue embedding changes by more than :code:`tissue_tol`.
+        """
+        tol = getattr(self, "tissue_tol", 0.0)
+        key = (mg_x.shape[0], str(mg_x.device), tuple((t, tuple(n)) for t, n in sorted(tissue_neighbors.items())))
+        if getattr(self, "tissue_op_key", None) != key: # Operators are built once per metagraph (models saved before these updates have none)
+            self.tissue_ops = dict()
+            self.tissue_op_key = key
+        def apply(mg_x, sweeps):
+            if sweeps not in self.tissue_ops: self.tissue_ops[sweeps] = tissue_operator(tissue_neighbors, mg_x.shape[0], sweeps, mg_x.device)
+            tissue_idx, tissue_op = self.tissue_ops[sweeps]
+            tissue_x = tissue_op @ mg_x
+            return mg_x.index_copy(0, tissue_idx, tissue_x), (tissue_x - mg_x[tissue_idx]).abs().max()
+        if tol <= 0: return apply(mg_x, self.tissue_update)[0]
+        for start in range(0, self.tissue_update, TISSUE_CHECK_EVERY):
+            mg_x, delta = apply(mg_x, min(TISSUE_CHECK_EVERY, self.tissue_update - start))
+            if delta <= tol: break
+        return mg_x
+
     def forward(self, ppi_x, mg_x, ppi_metapaths, mg_metapaths, ppi_edge_index, mg_edge_index, tissue_neighbors, init_cci=False):
         
-        if init_cci: mg_x_list = []
-        else: # Project metagraph embeddings to the same dimension as PPI
+        mg_x_list = [] # Pooled PPI embeddings of every cell type
+        if not init_cci: # Project metagraph embeddings to the same dimension as PPI
             mg_x = self._per_data_forward(mg_x, mg_metapaths, self.mg_conv_in)
         
-        for celltype, x in ppi_x.items(): # Iterate through cell-type specific PPI layers
-            if len(ppi_metapaths[celltype]) == 0: ppi_x[celltype] = []
-            else:
-                ppi_x[celltype] = self._per_data_forward(x, ppi_metapaths[celltype], self.ppi_w[celltype])
+        ppi_x = grouped_metapath_forward(ppi_x, ppi_metapaths, self.ppi_w, self.W, self.b, self.q) # Cell-type specific PPI layers
+        for celltype, x in ppi_x.items():
 
             # Attention on PPI nodes per cell type
             w = torch.sum(self.pc_W * ppi_x[celltype].unsqueeze(-1), dim=-2) + self.pc_b
@@ -89,20 +310,26 @@ class PCTConv(nn.Module):
             gamma = torch.softmax(gamma, dim=1)
             self.ppi_attn[celltype] = gamma.squeeze(0)
 
-            if init_cci: # Initialize CCI embeddings using PPI embeddings
-                weighted_x = torch.sum(ppi_x[celltype] * self.ppi_attn[celltype].unsqueeze(-1), dim=0)
-                mg_x_list.append(weighted_x)
-            else: # Update CCI embeddings
-                mg_x[celltype, :] += torch.sum(ppi_x[celltype] * self.ppi_attn[celltype].unsqueeze(-1), dim=0)
+            weighted_x = torch.sum(ppi_x[celltype] * self.ppi_attn[celltype].unsqueeze(-1), dim=0)
+            mg_x_list.append(weighted_x)
+
+        # Cell types that are not trained in this step (see ContextScheduler) contribute their last pooled embedding
+        if not hasattr(self, "pooled"): self.pooled = dict() # Models saved before partial steps
+        celltypes = list(ppi_x.keys())
+        if self.training: # Only training steps update the state (evaluation and get_embeddings leave it as trained)
+            for celltype, weighted_x in zip(celltypes, mg_x_list): self.pooled[celltype] = weighted_x.detach()
+        if len(celltypes) < self.ppi_w.num_groups:
+            pooled = dict(zip(celltypes, mg_x_list))
+            celltypes = list(range(self.ppi_w.num_groups))
+            mg_x_list = [pooled[c] if c in pooled else self.pooled.get(c, torch.zeros_like(mg_x_list[0])) for c in celltypes]
 
         if init_cci: # Concatenate initialized metagraph embeddings
             mg_x = torch.stack(mg_x_list)
             bto = torch.zeros(len(tissue_neighbors), mg_x.shape[1])
             mg_x = torch.cat((mg_x, torch.normal(bto, std=1).to(mg_x.device)))
-        for i in range(self.tissue_update): # Initialize tissue embeddings in a more meaningful way
-            for t in sorted(tissue_neighbors):
-                assert len(tissue_neighbors[t]) != 0
-                mg_x[t, :] = torch.mean(mg_x[tissue_neighbors[t]], 0)
+        else: # Update CCI embeddings (out of place, so that no input or autograd-saved tensor is modified)
+            mg_x = mg_x.index_add(0, torch.tensor(celltypes, dtype=torch.long, device=mg_x.device), torch.stack(mg_x_list))
+        mg_x = self._update_tissues(mg_x, tissue_neighbors) # Initialize tissue embeddings in a more meaningful way
         
         mg_x = self._per_data_forward(mg_x, mg_metapaths, self.mg_conv_out)
         
@@ -118,10 +345,8 @@ class PPIConv(nn.Module):
         self.sem_att_channels = sem_att_channels
         self.node_heads = node_heads
 
-        # Independent GAT per cell type specific PPI network
-        self.ppi_w = torch.nn.ModuleList()
-        for celltype, ppi in ppi_data.items():
-            self.ppi_w.append(GATv2Conv(in_channels, out_channels, node_heads))
+        # Independent GAT per cell type specific PPI network (run together)
+        self.ppi_w = GroupedGATv2Conv(len(ppi_data), in_channels, out_channels, node_heads)
 
         self.W = nn.Parameter(torch.Tensor(1, 1, out_channels * node_heads, sem_att_channels))
         self.b = nn.Parameter(torch.Tensor(1, 1, sem_att_channels))
@@ -137,34 +362,13 @@ class PPIConv(nn.Module):
         zeros(self.b)
         glorot(self.q)
 
-    def _per_data_forward(self, x, metapaths, node_conv):
-
-        # Calculate node-level attention representations
-        out = [node_conv(x, metapath) for metapath in metapaths if metapath.shape[1] > 0]
-        out = torch.stack(out, dim=1).to(x.device)
-        
-        # Apply non-linearity
-        out = F.leaky_relu(out)
-
-        # Aggregate node-level representation using semantic level attention
-        w = torch.sum(self.W * out.unsqueeze(-1), dim=-2) + self.b
-        w = torch.tanh(w)
-        beta = torch.sum(self.q * w, dim=-1)
-        beta = torch.softmax(beta, dim=1)
-        z = torch.sum(out * beta.unsqueeze(-1), dim=1)
-
-        return z
-
     def forward(self, ppi_x, ppi_metapaths, mg_x, ppi_attn):
         
-        for celltype, x in ppi_x.items(): # Iterate through cell-type specific PPI layers
-
-            if len(ppi_metapaths[celltype]) == 0: ppi_x[celltype] = []
-            else: # Update using meta-path attention
-                ppi_x[celltype] = self._per_data_forward(x, ppi_metapaths[celltype], self.ppi_w[celltype])
+        ppi_x = grouped_metapath_forward(ppi_x, ppi_metapaths, self.ppi_w, self.W, self.b, self.q) # Update using meta-path attention
+        for celltype in ppi_x:
 
             # Downpool using cell-type embedding
             gamma = ppi_attn[celltype] # (n,) where n = number of proteins in the cell type (in the batch)
-            ppi_x[celltype] += (mg_x[celltype, :].repeat(len(gamma), 1) * gamma.unsqueeze(-1))
+            ppi_x[celltype] = ppi_x[celltype] + (mg_x[celltype, :].repeat(len(gamma), 1) * gamma.unsqueeze(-1))
         
         return ppi_x
\ No newline at end of file
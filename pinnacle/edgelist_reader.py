@@ -0,0 +1,105 @@
+"""
+Streaming reader for whitespace-delimited edge lists (global PPI and context PPI layers).
+
+The node columns are parsed straight into int32 arrays, without building networkx graphs. Edge lists compressed with gzip (:code:`.gz`) or zstd (:code:`.zst`) are decompressed on the fly while reading. Node ids and edge order are the same as those of :code:`nx.read_edgelist`, so node :code:`i` and edge :code:`j` refer to the same protein and interaction as in models trained on networkx-loaded inputs.
+"""
+from array import array
+import csv
+import gzip
+import numpy as np
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError: # Only needed for .zst inputs
+    zstandard = None
+
+
+COMPRESSION_SUFFIXES = (".gz", ".zst")
+
+
+def open_edgelist(f: str, mode: str = "rt"):
+    """
+    Open an edge list that is plain text or compressed with gzip (:code:`.gz`) or zstd (:code:`.zst`), decompressing on the fly.
+
+    :param f: Path to the edge list.
+    :param mode: File mode (e.g., :code:`rt`, :code:`rb`, or :code:`wb`).
+    """
+    if f.endswith(".gz"): return gzip.open(f, mode)
+    if f.endswith(".zst"):
+        assert zstandard is not None, "Reading %s requires the zstandard package" % f
+        return zstandard.open(f, mode)
+    return open(f, mode)
+
+
+def strip_compression(f: str) -> str:
+    """
+    Filename without its compression suffix (e.g., :code:`<CONTEXT>_subgraph.txt.gz` -> :code:`<CONTEXT>_subgraph.txt`).
+    """
+    for suffix in COMPRESSION_SUFFIXES:
+        if f.endswith(suffix): return f[ : -len(suffix)]
+    return f
+
+
+def read_edgelist(f: str, comments: str = "#") -> tuple:
+    """
+    Read an undirected edge list. Only the first two columns of each line are used (remaining columns are edge data).
+
+    :param f: Path to the edge list (plain, :code:`.gz` or :code:`.zst`).
+    :param comments: Character marking the start of a comment.
+
+    :return: List of node names (node :code:`i` is the :code:`i`-th name to appear in the file) and a (2, E) int32 edge index.
+    """
+    try:
+        src, dst, nodes = _parse_columns(f, comments)
+    except ValueError: # Ragged lines (e.g., edge data on some lines only) or an empty file
+        src, dst, nodes = _parse_lines(f, comments)
+    return nodes, nx_edge_order(src, dst, len(nodes))
+
+
+def _parse_columns(f: str, comments: str) -> tuple:
+    """
+    Parse the two node columns with pandas' C parser, which reads the (decompressed) stream in large blocks. Nodes are numbered in order of first appearance, reading each line left to right. Quotes are part of node names, as in :code:`nx.read_edgelist`.
+    """
+    with open_edgelist(f, "rb") as fin:
+        df = pd.read_csv(fin, sep=r"\s+", header=None, usecols=[0, 1], comment=comments, dtype=str, na_filter=False, quoting=csv.QUOTE_NONE)
+    pairs = df.to_numpy()
+    pairs = pairs[(pairs != "").all(axis=1)] # Lines with a single node are skipped
+    codes, nodes = pd.factorize(pairs.ravel())
+    codes = codes.astype(np.int32).reshape(-1, 2)
+    return codes[:, 0], codes[:, 1], nodes.tolist()
+
+
+def _parse_lines(f: str, comments: str) -> tuple:
+    """
+    Parse the edge list line by line (same semantics as :code:`nx.read_edgelist`).
+    """
+    index = dict()
+    src = array("i")
+    dst = array("i")
+    with open_edgelist(f, "rt") as fin:
+        for line in fin:
+            p = line.find(comments)
+            if p >= 0: line = line[:p]
+            tokens = line.split(None, 2)
+            if len(tokens) < 2: continue
+            src.append(index.setdefault(tokens[0], len(index)))
+            dst.append(index.setdefault(tokens[1], len(index)))
+    return np.frombuffer(src, dtype=np.int32), np.frombuffer(dst, dtype=np.int32), list(index)
+
+
+def nx_edge_order(src: np.ndarray, dst: np.ndarray, num_nodes: int) -> np.ndarray:
+    """
+    Deduplicate undirected edges and order them the way :code:`nx.Graph.edges` would. networkx yields each edge once, as :code:`(u, v)` with :code:`u` the node added first, grouped by :code:`u` in node order and, within a group, in order of first appearance in the file.
+
+    :return: (2, E) int32 edge index.
+    """
+    lo = np.minimum(src, dst)
+    hi = np.maximum(src, dst)
+    _, first = np.unique(lo.astype(np.int64) * num_nodes + hi, return_index=True)
+    first.sort() # First occurrence of every edge, in file order
+    lo = lo[first]
+    hi = hi[first]
+    order = np.argsort(lo, kind="stable")
+    return np.stack([lo[order], hi[order]]).astype(np.int32)
+
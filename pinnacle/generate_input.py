@@ -1,5 +1,7 @@
 import glob
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
 import pandas as pd
 import numpy as np
 import random
@@ -7,89 +9,207 @@ import networkx as nx
 import torch
 from torch_geometric.data import Data
 import os
+import time
 
+import input_cache
+import validate_input
+from split_manifest import index_to_mask
+from edgelist_reader import read_edgelist, open_edgelist, strip_compression
+from node_vocab import NodeVocab
+from load_report import LoadReport
 
-def split_data(num_y):
-    split_idx = list(range(num_y))
-    random.shuffle(split_idx)
-    train_idx = split_idx[ : int(len(split_idx) * 0.8)] # Train mask
-    train_mask = torch.zeros(num_y, dtype = torch.bool)
-    train_mask[train_idx] = 1
-    val_idx = split_idx[ int(len(split_idx) * 0.8) : int(len(split_idx) * 0.9)] # Val mask
-    val_mask = torch.zeros(num_y, dtype=torch.bool)
-    val_mask[val_idx] = 1
-    test_idx = split_idx[int(len(split_idx) * 0.9) : ] # Test mask
-    test_mask = torch.zeros(num_y, dtype=torch.bool)
-    test_mask[test_idx] = 1
+
+def split_data(num_y, seed=None):
+    if seed is None: split_idx = np.random.permutation(num_y)
+    else: split_idx = np.random.default_rng(seed).permutation(num_y) # Independent of the order in which layers are split
+    train_mask = index_to_mask(split_idx[ : int(num_y * 0.8)], num_y) # Train mask
+    val_mask = index_to_mask(split_idx[int(num_y * 0.8) : int(num_y * 0.9)], num_y) # Val mask
+    test_mask = index_to_mask(split_idx[int(num_y * 0.9) : ], num_y) # Test mask
     return train_mask, val_mask, test_mask
 
 
-def read_ppi(ppi_dir):
-    orig_ppi_layers = dict()
+class PPILayer:
+    """
+    Protein interaction network of one context, stored as flat arrays.
+
+    :param nodes: Protein names, where node :code:`i` of the layer is :code:`nodes[i]` (order of first appearance in the edge list).
+    :param edge_index: (2, E) array of edges between node ids.
+    :param indptr: CSR row pointers of the (undirected) adjacency.
+    :param indices: CSR column indices of the (undirected) adjacency.
+    """
+    def __init__(self, nodes, edge_index, indptr, indices):
+        self.nodes = nodes
+        self.edge_index = edge_index
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes.tolist())
+
+    def degree(self):
+        return np.bincount(np.asarray(self.edge_index).ravel(), minlength=len(self.nodes))
+
+
+def parse_ppi_layer(f):
+
+    # Read edgelist (nodes are relabelled in order of appearance)
+    nodes, edge_index = read_edgelist(f)
+    return input_cache.edgelist_arrays(nodes, edge_index)
+
+
+def load_ppi_layer(f, cache_dir, seed, split=None):
+    start = time.perf_counter()
+
+    # Read edgelist (or its cached arrays)
+    arrays = input_cache.load_arrays(f, "layer_" + ppi_context(f), cache_dir, parse_ppi_layer)
+
+    # Split into train/val/test (or reuse the split of a manifest)
+    num_edges = arrays["edge_index"].shape[1]
+    if split is None:
+        train_mask, val_mask, test_mask = split_data(num_edges, seed)
+    else:
+        train_mask, val_mask, test_mask = [index_to_mask(idx, num_edges) for idx in split]
+        assert int((train_mask | val_mask | test_mask).sum()) == num_edges, "Split manifest does not match %s" % f
+    return PPILayer(arrays["nodes"], arrays["edge_index"], arrays["indptr"], arrays["indices"]), train_mask.numpy(), val_mask.numpy(), test_mask.numpy(), time.perf_counter() - start
+
+
+def ppi_context(f):
+    filename = os.path.basename(strip_compression(f))  # Get just the filename without the path (and compression suffix)
+    return filename.replace("_subgraph.txt", "")
+
+
+def select_contexts(files, contexts):
+    if contexts is None: return files
+    if isinstance(contexts, int): return files[ : contexts] # First N contexts
+    available = {ppi_context(f): f for f in files}
+    missing = [c for c in contexts if c not in available]
+    assert len(missing) == 0, "No PPI layer for contexts: %s" % missing
+    return [available[c] for c in sorted(set(contexts))]
+
+
+def loading_pool(workers):
+    """
+    Process pool for loading PPI layers. Workers are forked (with spawn or forkserver, every worker would re-run the module-level code of train.py, e.g., wandb.init and read_data, when importing it), and forked right away: create the pool before any torch op or wandb.init has started threads, since forking a process with running threads can deadlock the workers.
+
+    :param workers: Number of worker processes.
+    :return: Executor whose workers are already running.
+    """
+    assert "fork" in mp.get_all_start_methods(), "--load_workers > 1 requires the fork start method, which is not available on this platform (use --load_workers 1)"
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("fork"))
+    for started in [executor.submit(os.getpid) for _ in range(workers)]: started.result() # Workers are otherwise forked on the first map, i.e., after torch and wandb started their threads
+    return executor
+
+
+def read_ppi(ppi_dir, cache_dir=None, load_workers=1, edge_splits=None, contexts=None, report=None, load_pool=None):
+    report = LoadReport() if report is None else report
     ppi_layers = dict()
     ppi_train = dict()
     ppi_val = dict()
     ppi_test = dict()
 
-    for f in glob.glob(ppi_dir + "*.txt"): # Expected format of filename: <PPI_DIR>/<CONTEXT>.<suffix>
-
-        # Parse name of context
-        filename = os.path.basename(f)  # Get just the filename without the path
-        context = filename.replace("_subgraph.txt", "")
-
-        # Read edgelist
-        ppi = nx.read_edgelist(f)
-
-        # Relabel PPI nodes
-        mapping = {n: idx for idx, n in enumerate(ppi.nodes())}
-        ppi_layers[context] = nx.relabel_nodes(ppi, mapping)
-        orig_ppi_layers[context] = ppi
-        assert nx.is_connected(ppi_layers[context])
+    files = sorted(f for f in glob.glob(ppi_dir + "*") if strip_compression(f).endswith(".txt")) # Expected format of filename: <PPI_DIR>/<CONTEXT>.<suffix>[.gz|.zst]
+    duplicates = [c for c, n in Counter(map(ppi_context, files)).items() if n > 1]
+    assert len(duplicates) == 0, "Multiple PPI layers (e.g., plain and compressed) for contexts: %s" % duplicates
+    seeds = [random.getrandbits(32) for _ in files] # Drawn up front so that serial and parallel loading split identically
+    
+    # Only load the requested contexts (each keeps the seed, and thus the split, it has in a full run)
+    selected = set(select_contexts(files, contexts))
+    seeds = [seed for f, seed in zip(files, seeds) if f in selected]
+    files = [f for f in files if f in selected]
+    if edge_splits is not None: # A manifest's splits (incl. the center loss split over the nodes of all contexts) only apply to the contexts it was saved for
+        loaded = set(map(ppi_context, files))
+        assert loaded == set(edge_splits), "Split manifest does not match the loaded contexts (not in the manifest: %s; only in the manifest: %s)" % (sorted(loaded - set(edge_splits)), sorted(set(edge_splits) - loaded))
+    splits = [edge_splits[ppi_context(f)] if edge_splits is not None else None for f in files]
+    if load_pool is not None: # Started by the caller (see loading_pool)
+        layers = list(load_pool.map(load_ppi_layer, files, [cache_dir] * len(files), seeds, splits))
+    elif load_workers > 1:
+        with loading_pool(load_workers) as executor:
+            layers = list(executor.map(load_ppi_layer, files, [cache_dir] * len(files), seeds, splits))
+    else:
+        layers = [load_ppi_layer(f, cache_dir, seed, split) for f, seed, split in zip(files, seeds, splits)]
 
-        # Split into train/val/test
-        ppi_train[context], ppi_val[context], ppi_test[context] = split_data(len(ppi_layers[context].edges))
-    return orig_ppi_layers, ppi_layers, ppi_train, ppi_val, ppi_test
+    for f, (layer, train_mask, val_mask, test_mask, seconds) in zip(files, layers):
+        context = ppi_context(f)
+        report.add_context(context, nodes=len(layer), edges=int(layer.edge_index.shape[1]), load_s=seconds)
+        ppi_layers[context] = layer
+        ppi_train[context] = torch.from_numpy(train_mask)
+        ppi_val[context] = torch.from_numpy(val_mask)
+        ppi_test[context] = torch.from_numpy(test_mask)
+    return ppi_layers, ppi_train, ppi_val, ppi_test
 
 
-def create_data(G, train_mask, val_mask, test_mask, node_type, edge_type, x):
-    edge_index = torch.tensor(list(G.edges)).t().contiguous()
+def create_data(edge_index, train_mask, val_mask, test_mask, node_type, edge_type, x=None, x_index=None):
+    edge_index = torch.from_numpy(np.asarray(edge_index, dtype=np.int64)).contiguous()
     y = torch.ones(edge_index.size(1))
     num_classes = len(torch.unique(y))
     node_type = torch.tensor(node_type)
     edge_type = torch.tensor(edge_type)
-    new_G = Data(x = x, y = y, num_classes = num_classes, edge_index = edge_index, node_type = node_type, edge_attr = edge_type, train_mask = train_mask, val_mask = val_mask, test_mask = test_mask)
+    new_G = Data(x = x, x_index = x_index, y = y, num_classes = num_classes, edge_index = edge_index, node_type = node_type, edge_attr = edge_type, train_mask = train_mask, val_mask = val_mask, test_mask = test_mask, num_nodes = len(node_type))
     return new_G
 
 
-def read_global_ppi(f):
-    # Read the text file
-    with open(f, 'r') as file:
-        # Create a list of tuples, where each tuple is an edge
-        edges = [tuple(line.strip().split()) for line in file if line.strip()]
+def parse_global_ppi(f):
+    nodes, edge_index = read_edgelist(f)
+    return input_cache.edgelist_arrays(nodes, edge_index)
+
+
+def read_metagraph(mg_f, contexts, cache_dir=None, subset=False):
 
-    # Instantiate graph object
-    G = nx.Graph()
+    def parse_metagraph(f):
+        with open_edgelist(f, "rt") as fin:
+            metagraph = nx.read_edgelist(fin, data=False, delimiter = "\t", create_using=nx.DiGraph)
+        if subset: # Keep the loaded cell types and the tissues that lead to them (i.e., that their embeddings are initialized from)
+            metagraph_ct = metagraph.subgraph([n for n in metagraph.nodes if n in contexts or "cells" in n])
+            keep = set(n for n in contexts if n in metagraph_ct)
+            for c in list(keep): keep.update(nx.ancestors(metagraph_ct, c))
+            sub = nx.DiGraph()
+            sub.add_nodes_from([n for n in metagraph.nodes if n in keep])
+            sub.add_edges_from([(u, v) for u, v in metagraph.edges if u in keep and v in keep])
+            metagraph = sub
+        nodes = list(metagraph.nodes)
+        index = {n: i for i, n in enumerate(nodes)}
+        edge_index = np.asarray([[index[u], index[v]] for u, v in metagraph.edges], dtype=np.int32).reshape(-1, 2).T
+        mapping = sorted(contexts) + sorted([n for n in nodes if "cells" in n]) # Contexts first, then tissues
+        return {"nodes": np.asarray(nodes, dtype=str), "edge_index": np.ascontiguousarray(edge_index), "mapping": np.asarray(mapping, dtype=str)}
 
-    # Add edges (from the file) to the graph object
-    G.add_edges_from(edges)
+    # The mapping depends on the contexts, so they are part of the cache key
+    arrays = input_cache.load_arrays(mg_f, "metagraph", cache_dir, parse_metagraph, extra_key="\n".join(sorted(contexts) + ["subset"] * subset))
 
-    return G
+    # Rebuild the (small) metagraph with the same node and edge order as the edgelist
+    nodes = arrays["nodes"].tolist()
+    metagraph = nx.DiGraph()
+    metagraph.add_nodes_from(nodes)
+    metagraph.add_edges_from((nodes[u], nodes[v]) for u, v in np.asarray(arrays["edge_index"]).T.tolist())
+    mg_mapping = {n: i for i, n in enumerate(arrays["mapping"].tolist())}
+    return metagraph, mg_mapping
 
-def read_data(G_f, ppi_dir, mg_f, feat_mat_dim):
+
+def read_data(G_f, ppi_dir, mg_f, feat_mat_dim, cache_dir=None, load_workers=1, edge_splits=None, contexts=None, report=None, load_pool=None):
+    report = LoadReport() if report is None else report # Wall time and memory of every stage
 
     # Read global PPI 
     #G = nx.read_edgelist(G_f)
-    G = read_global_ppi(G_f)
+    with report.stage("global_ppi"):
+        node_vocab = NodeVocab(input_cache.load_arrays(G_f, "global_ppi", cache_dir, parse_global_ppi)["nodes"])
 
-    feat_mat = torch.normal(torch.zeros(len(G.nodes), feat_mat_dim), std=1)
+    with report.stage("feat_mat"):
+        feat_mat = torch.normal(torch.zeros(len(node_vocab), feat_mat_dim), std=1)
     
     # Read PPI layers
-    orig_ppi_layers, ppi_layers, ppi_train, ppi_val, ppi_test = read_ppi(ppi_dir)
+    with report.stage("ppi_layers"):
+        ppi_layers, ppi_train, ppi_val, ppi_test = read_ppi(ppi_dir, cache_dir, load_workers, edge_splits, contexts, report, load_pool)
+
+    # Check connectivity of all layers (reports every disconnected context), outside the ppi_layers stage so that its time is not counted twice
+    with report.stage("validate_ppi"):
+        validate_input.check_ppi_layers(ppi_layers)
     print("Number of PPI layers:", len(ppi_layers), len(ppi_train), len(ppi_val), len(ppi_test))
 
     # Read metagraph
-    metagraph = nx.read_edgelist(mg_f, data=False, delimiter = "\t", create_using=nx.DiGraph)
-    assert nx.is_connected(metagraph.to_undirected())
+    with report.stage("metagraph"):
+        metagraph, mg_mapping = read_metagraph(mg_f, list(ppi_layers), cache_dir, subset=contexts is not None)
     # Print the degrees of all nodes
     for node, degree in metagraph.degree():
         print(f"Node {node} has a degree of {degree}")
@@ -98,49 +218,54 @@ def read_data(G_f, ppi_dir, mg_f, feat_mat_dim):
     orig_mg = metagraph
     print("Number of nodes:", len(metagraph.nodes), "Number of edges:", len(metagraph.edges))
     print(ppi_layers)
-    mg_mapping = {n: i for i, n in enumerate(sorted(ppi_layers))}
-    mg_mapping.update({n: i + len(ppi_layers) for i, n in enumerate(sorted([n for n in metagraph.nodes if "cells" in n]))})
     assert len(mg_mapping) == len(metagraph.nodes), set(metagraph.nodes).difference(set(list(mg_mapping.keys())))
     #print(mg_mapping)
 
     # Set up Data object
-    mg_nodetype = [0 if "cells" in n else 1 for n in mg_mapping] # Tissue nodes = 0, Cell-type nodes = 1, protein nodes = 2
-    mg_edgetype = []
-    for edges in metagraph.edges:
-        if "cells" in edges[0] and "cells" in edges[1]: mg_edgetype.append(0) # tissue-tissue edge
-        elif "cells" in edges[0] and "cells" not in edges[1]: mg_edgetype.append(1) # tissue-cell edge
-        elif "cells" not in edges[0] and "cells" in edges[1]: mg_edgetype.append(2) # cell-tissue edge
-        elif "cells" not in edges[0] and "cells" not in edges[1]: mg_edgetype.append(3) # cell-cell edge
-        else:
-            print(edges)
-            raise NotImplementedError
-    tissue_neighbors = {mg_mapping[t]: [mg_mapping[n] for n in metagraph.neighbors(t)] for t in metagraph.to_undirected().nodes if "cells" in t}
-    metagraph = nx.relabel_nodes(metagraph, mg_mapping)
-    mg_mask = torch.ones(len(metagraph.edges), dtype = torch.bool) # Pass in all meta graph edges during training, validation, and test
-    mg_data = create_data(metagraph, mg_mask, mg_mask, mg_mask, mg_nodetype, mg_edgetype, mg_feat_mat)
+    with report.stage("metagraph_data"):
+        mg_nodetype = [0 if "cells" in n else 1 for n in mg_mapping] # Tissue nodes = 0, Cell-type nodes = 1, protein nodes = 2
+        mg_edgetype = []
+        for edges in metagraph.edges:
+            if "cells" in edges[0] and "cells" in edges[1]: mg_edgetype.append(0) # tissue-tissue edge
+            elif "cells" in edges[0] and "cells" not in edges[1]: mg_edgetype.append(1) # tissue-cell edge
+            elif "cells" not in edges[0] and "cells" in edges[1]: mg_edgetype.append(2) # cell-tissue edge
+            elif "cells" not in edges[0] and "cells" not in edges[1]: mg_edgetype.append(3) # cell-cell edge
+            else:
+                print(edges)
+                raise NotImplementedError
+        tissue_neighbors = {mg_mapping[t]: [mg_mapping[n] for n in metagraph.neighbors(t)] for t in metagraph.to_undirected().nodes if "cells" in t}
+        mg_edge_index = np.asarray([[mg_mapping[u], mg_mapping[v]] for u, v in metagraph.edges]).reshape(-1, 2).T
+        if contexts is None: # The metagraph of a subset of contexts can be disconnected on valid input (e.g., contexts under unrelated tissues, joined only through contexts that are not loaded)
+            validate_input.check_metagraph(mg_edge_index, len(metagraph.nodes))
+        mg_mask = torch.ones(len(metagraph.edges), dtype = torch.bool) # Pass in all meta graph edges during training, validation, and test
+        mg_data = create_data(mg_edge_index, mg_mask, mg_mask, mg_mask, mg_nodetype, mg_edgetype, mg_feat_mat)
 
     # Set up PPI Data objects
-    orig_ppi_layers_remapped = {mg_mapping[k]: v for k, v in orig_ppi_layers.items() if k in mg_mapping}
+    orig_ppi_layers = ppi_layers
     ppi_layers = {mg_mapping[k]: v for k, v in ppi_layers.items() if k in mg_mapping}
     ppi_train = {mg_mapping[k]: v for k, v in ppi_train.items() if k in mg_mapping}
     ppi_val = {mg_mapping[k]: v for k, v in ppi_val.items() if k in mg_mapping}
     ppi_test = {mg_mapping[k]: v for k, v in ppi_test.items() if k in mg_mapping}    
     ppi_data = dict()
-    for cluster, ppi in ppi_layers.items():
-        ppi_nodetype = [2] * len(ppi.nodes) # protein nodes = 2
-        ppi_edgetype = [4] * len(ppi.edges) # protein-protein edge
-        ppi_node_names = orig_ppi_layers_remapped[cluster].nodes()
-        p_index = [idx for idx, p in enumerate(list(G.nodes())) if p in ppi_node_names]
-        assert len(p_index) == len(ppi_node_names)
-        c_feat_mat = feat_mat[p_index, :]
-        assert c_feat_mat.shape[0] == len(ppi.nodes)
-        ppi_data[cluster] = create_data(ppi, ppi_train[cluster], ppi_val[cluster], ppi_test[cluster], ppi_nodetype, ppi_edgetype, c_feat_mat)
+    context_names = {mg_mapping[k]: k for k in orig_ppi_layers if k in mg_mapping}
+    with report.stage("ppi_data"):
+        for cluster, ppi in ppi_layers.items():
+            start = time.perf_counter()
+            ppi_nodetype = [2] * len(ppi.nodes) # protein nodes = 2
+            ppi_edgetype = [4] * ppi.edge_index.shape[1] # protein-protein edge
+            global_id = torch.from_numpy(node_vocab.lookup(ppi.nodes)) # Node i of the layer is protein global_id[i]
+            p_index = torch.sort(global_id).values # Feature rows are taken in global node order
+            assert p_index.shape[0] == len(ppi.nodes)
+            relabelled = time.perf_counter()
+            ppi_data[cluster] = create_data(ppi.edge_index, ppi_train[cluster], ppi_val[cluster], ppi_test[cluster], ppi_nodetype, ppi_edgetype, x_index = p_index) # Rows of the shared feat_mat, gathered by the model per batch
+            ppi_data[cluster].global_id = global_id
+            report.add_context(context_names[cluster], relabel_s=relabelled - start, create_data_s=time.perf_counter() - relabelled)
 
     #  Set up edge attr dict
     edge_attr_dict = {"tissue_tissue": 0, "tissue_cell": 1, "cell_tissue": 2, "cell_cell": 3, "protein_protein": 4}
     
     # Return celltype specific PPI network data
-    return ppi_data, mg_data, edge_attr_dict, mg_mapping, tissue_neighbors, orig_ppi_layers, orig_mg
+    return ppi_data, mg_data, edge_attr_dict, mg_mapping, tissue_neighbors, orig_ppi_layers, orig_mg, node_vocab, feat_mat
 
 
 def subset_ppi(num_subset, ppi_data, ppi_layers):
@@ -168,17 +293,16 @@ def get_metapaths():
     return ppi_metapaths, mg_metapaths
 
 
-def get_centerloss_labels(args, celltype_map, ppi_layers):
-    center_loss_labels = []
-    train_mask = []
-    val_mask = []
-    test_mask = []
+def get_centerloss_labels(args, celltype_map, ppi_layers, center_loss_idx=None):
     print(celltype_map)
-    for celltype, ppi in ppi_layers.items():
-        center_loss_labels += [celltype_map[celltype]] * len(ppi.nodes)
-    center_loss_idx = random.sample(range(len(center_loss_labels)), len(center_loss_labels))
-    train_mask = center_loss_idx[ : int(0.8 * len(center_loss_idx))]
-    val_mask = center_loss_idx[len(train_mask) : len(train_mask) + int(0.1 * len(center_loss_idx))]
-    test_mask = center_loss_idx[len(train_mask) + len(val_mask) : ]
-    print("Center loss labels:", Counter(center_loss_labels))
+    center_loss_labels = np.repeat([celltype_map[celltype] for celltype in ppi_layers], [len(ppi.nodes) for ppi in ppi_layers.values()])
+    if center_loss_idx is None:
+        center_loss_idx = np.random.permutation(len(center_loss_labels)).astype(np.int32)
+        train_mask = center_loss_idx[ : int(0.8 * len(center_loss_idx))]
+        val_mask = center_loss_idx[len(train_mask) : len(train_mask) + int(0.1 * len(center_loss_idx))]
+        test_mask = center_loss_idx[len(train_mask) + len(val_mask) : ]
+    else: # Reuse the split of a manifest
+        train_mask, val_mask, test_mask = center_loss_idx
+        assert len(train_mask) + len(val_mask) + len(test_mask) == len(center_loss_labels)
+    print("Center loss labels:", Counter(center_loss_labels.tolist()))
     return center_loss_labels, train_mask, val_mask, test_mask
@@ -0,0 +1,132 @@
+"""
+On-disk cache of parsed PINNACLE input networks.
+
+Every input file (global PPI, one entry per context PPI layer, metagraph) is parsed once into flat numpy arrays and saved as :code:`.npy` files in a directory named after the SHA-1 of the file's contents. Later runs memory-map those arrays with :code:`np.load(mmap_mode="r")` instead of re-parsing the text, and a changed input file only invalidates its own entry. Up to :code:`ENTRIES_PER_NAME` entries are kept per input, so runs that alternate between inputs of the same name (e.g., the metagraph of a context subset and of all contexts) reuse each other's entries.
+
+Layout of :code:`cache_dir`::
+
+    <name>.<digest>/nodes.npy         node names, node i is nodes[i]
+    <name>.<digest>/edge_index.npy    (2, E) int32 COO edges over node ids
+    <name>.<digest>/indptr.npy        CSR row pointers of the undirected adjacency
+    <name>.<digest>/indices.npy       CSR column indices of the undirected adjacency
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+CACHE_VERSION = 1 # Bump when the layout or the parsing of an entry changes
+ENTRIES_PER_NAME = 4 # Entries kept per input (e.g., metagraph mappings of subset and full runs), least recently used ones are evicted
+
+
+def file_digest(f: str, extra_key: str = "", chunk_size: int = 1 << 20) -> str:
+    """
+    Content hash of an input file.
+
+    :param f: Path to the input file.
+    :param extra_key: Additional string that the cached entry depends on (e.g., the set of contexts for the metagraph mapping).
+    :param chunk_size: Number of bytes read at a time.
+
+    :return: Hex digest keying the cache entry of :code:`f`.
+    """
+    h = hashlib.sha1()
+    h.update(("v%d\n%s\n" % (CACHE_VERSION, extra_key)).encode())
+    with open(f, "rb") as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def entry_dir(cache_dir: str, name: str, digest: str) -> str:
+    return os.path.join(cache_dir, "%s.%s" % (name, digest[:16]))
+
+
+def load_entry(cache_dir: str, name: str, digest: str) -> dict:
+    """
+    Memory-map all arrays of a cache entry. Returns :code:`None` if there is no entry for this content hash.
+    """
+    path = entry_dir(cache_dir, name, digest)
+    if not os.path.isdir(path): return None
+    try:
+        os.utime(path) # Mark as recently used (see evict_entries)
+    except OSError: # Read-only cache
+        pass
+    return {os.path.splitext(f)[0]: np.load(os.path.join(path, f), mmap_mode="r") for f in os.listdir(path) if f.endswith(".npy")}
+
+
+def save_entry(cache_dir: str, name: str, digest: str, arrays: dict) -> dict:
+    """
+    Write :code:`arrays` as a new cache entry, evicting the least recently used entries of the same input beyond :code:`ENTRIES_PER_NAME`, and return the memory-mapped arrays.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Write to a temporary directory first so that readers never see a partial entry
+    tmp = tempfile.mkdtemp(prefix=".tmp-", dir=cache_dir)
+    for key, arr in arrays.items():
+        np.save(os.path.join(tmp, key + ".npy"), arr)
+
+    try:
+        os.rename(tmp, entry_dir(cache_dir, name, digest))
+    except OSError: # Another process published the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+    evict_entries(cache_dir, name)
+    return load_entry(cache_dir, name, digest)
+
+
+def evict_entries(cache_dir: str, name: str, keep: int = ENTRIES_PER_NAME):
+    """
+    Remove all but the :code:`keep` most recently used entries of an input (e.g., entries built from older file contents).
+    """
+    entries = [os.path.join(cache_dir, d) for d in os.listdir(cache_dir) if d.rsplit(".", 1)[0] == name]
+    entries.sort(key=lambda d: os.path.getmtime(d), reverse=True)
+    for d in entries[keep : ]:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def load_arrays(f: str, name: str, cache_dir: str, parse_fn, extra_key: str = "") -> dict:
+    """
+    Parse an input file into arrays, going through the cache if :code:`cache_dir` is set.
+
+    :param f: Path to the input file.
+    :param name: Name of the cache entry (unique per input, e.g., :code:`layer_<context>`).
+    :param cache_dir: Cache directory. If empty or :code:`None`, :code:`parse_fn` is always called.
+    :param parse_fn: Function mapping :code:`f` to a dictionary of numpy arrays.
+    :param extra_key: Additional string that the parsed arrays depend on.
+
+    :return: Dictionary of (memory-mapped, if cached) numpy arrays.
+    """
+    if not cache_dir: return parse_fn(f)
+    digest = file_digest(f, extra_key)
+    arrays = load_entry(cache_dir, name, digest)
+    if arrays is None:
+        arrays = save_entry(cache_dir, name, digest, parse_fn(f))
+    return arrays
+
+
+def edgelist_arrays(nodes: list, edge_index: np.ndarray) -> dict:
+    """
+    Convert a relabelled edge list into cache arrays.
+
+    :param nodes: Node names, where node :code:`i` is :code:`nodes[i]`.
+    :param edge_index: (2, E) array of node ids.
+
+    :return: Dictionary with the node-name vocabulary, the COO edge index, and the CSR adjacency (both directions) of the graph.
+    """
+    num_nodes = len(nodes)
+    edge_index = np.asarray(edge_index, dtype=np.int32).reshape(2, -1)
+    indptr, indices = to_csr(edge_index, num_nodes)
+    return {"nodes": np.asarray(nodes, dtype=str), "edge_index": np.ascontiguousarray(edge_index), "indptr": indptr, "indices": indices}
+
+
+def to_csr(edge_index: np.ndarray, num_nodes: int) -> tuple:
+    """
+    CSR representation of an undirected edge index (each edge is stored in both directions).
+    """
+    row = np.concatenate([edge_index[0], edge_index[1]])
+    col = np.concatenate([edge_index[1], edge_index[0]])
+    order = np.argsort(row, kind="stable")
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row, minlength=num_nodes), out=indptr[1:])
+    return indptr, col[order].astype(np.int32)
@@ -0,0 +1,94 @@
+"""
+Timing and memory report of the input loading phase (:code:`read_data`): wall time and RSS growth of every stage, the process' RSS high-water mark after every stage, and node/edge counts and timings of every context.
+"""
+from contextlib import contextmanager
+import json
+import resource
+import sys
+import time
+
+
+def current_rss_mb() -> float:
+    """
+    Current resident set size in MB of this process (:code:`None` where :code:`/proc` is not available).
+    """
+    try:
+        with open("/proc/self/statm") as fin:
+            pages = int(fin.read().split()[1])
+    except OSError:
+        return None
+    return pages * resource.getpagesize() / (1 << 20)
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+    """
+    Resident set size high-water mark in MB of this process (:code:`RUSAGE_SELF`) or of its largest terminated child process (:code:`RUSAGE_CHILDREN`, e.g., loading workers). The mark covers the lifetime of the process, not a single stage: it only grows in stages that exceed all earlier usage.
+    """
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss / (1 << 20) if sys.platform == "darwin" else maxrss / (1 << 10) # Bytes on macOS, kilobytes on Linux
+
+
+class LoadReport:
+    """
+    Collects the stages and contexts of one :code:`read_data` call.
+
+    :param num_slowest: Number of slowest contexts to call out.
+    """
+    def __init__(self, num_slowest: int = 5):
+        self.num_slowest = num_slowest
+        self.start = time.perf_counter()
+        self.stages = []
+        self.contexts = dict()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time a stage of the loading phase, e.g. :code:`with report.stage("metagraph"): ...`. Memory is recorded as the change of the current RSS over the stage (memory the stage keeps), and the high-water marks after the stage (cumulative over all earlier stages).
+        """
+        start = time.perf_counter()
+        rss_start = current_rss_mb()
+        yield
+        rss_end = current_rss_mb()
+        self.stages.append({"stage": name, "seconds": time.perf_counter() - start,
+                            "rss_mb": rss_end, "rss_delta_mb": rss_end - rss_start if rss_end is not None else None,
+                            "max_rss_mb": peak_rss_mb(), "max_rss_children_mb": peak_rss_mb(resource.RUSAGE_CHILDREN)})
+
+    def add_context(self, context: str, **stats):
+        """
+        Record statistics of a context (e.g., :code:`nodes`, :code:`edges`, and timings ending in :code:`_s`). Statistics of the same context are merged.
+        """
+        self.contexts.setdefault(context, dict()).update(stats)
+
+    def context_seconds(self, context: str) -> float:
+        return sum(v for k, v in self.contexts[context].items() if k.endswith("_s"))
+
+    def slowest_contexts(self) -> list:
+        return sorted(self.contexts, key=self.context_seconds, reverse=True)[ : self.num_slowest]
+
+    def to_dict(self) -> dict:
+        return {"total_seconds": time.perf_counter() - self.start,
+                "max_rss_mb": peak_rss_mb(),
+                "stages": self.stages,
+                "contexts": self.contexts,
+                "slowest_contexts": [dict(context=c, seconds=self.context_seconds(c), **self.contexts[c]) for c in self.slowest_contexts()]}
+
+    def save(self, f: str):
+        with open(f, "w") as fout:
+            json.dump(self.to_dict(), fout, indent=2)
+        print("Saved load report at %s" % f)
+
+    def log(self, log_f=None):
+        """
+        Print a summary of the report (and write it to :code:`log_f`, if given).
+        """
+        report = self.to_dict()
+        lines = ["Load phase: %.2fs, max RSS %.1f MB" % (report["total_seconds"], report["max_rss_mb"])]
+        for s in report["stages"]:
+            delta = "%+.1f MB" % s["rss_delta_mb"] if s["rss_delta_mb"] is not None else "n/a"
+            lines.append("  %-16s %8.2fs  RSS %s  max RSS so far %.1f MB (workers %.1f MB)" % (s["stage"], s["seconds"], delta, s["max_rss_mb"], s["max_rss_children_mb"]))
+        lines.append("Slowest %d contexts:" % len(report["slowest_contexts"]))
+        for c in report["slowest_contexts"]:
+            lines.append("  %-40s %8.2fs  %d nodes, %d edges" % (c["context"], c["seconds"], c.get("nodes", 0), c.get("edges", 0)))
+        for l in lines:
+            print(l)
+            if log_f is not None: log_f.write(l + "\n")
@@ -5,23 +5,31 @@ import torch.nn.functional as F
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
-def calc_link_pred_loss(mg_pred, mg_y, ppi_preds, ppi_y, loss_type="BCE"):
+def calc_ppi_context_loss(ppi_preds, ppi_y):
+    # Mean loss of every cell type of the packed predictions (see PackedBatch)
+    loss = F.binary_cross_entropy(ppi_preds, ppi_y.y, reduction="none")
+    num_edges = torch.tensor(ppi_y.num_edges, dtype=loss.dtype, device=loss.device)
+    return torch.zeros_like(num_edges).index_add_(0, ppi_y.edge_context, loss) / num_edges
+
+
+def calc_link_pred_loss(mg_pred, mg_y, ppi_preds, ppi_y, loss_type="BCE", ppi_weights=None):
     
     # Calculate link prediction loss on metagraph
     mg_loss = 0
     if len(mg_pred) > 0:
         mg_loss = F.binary_cross_entropy(mg_pred, mg_y["y"].to(device))
 
-    # Calculate link prediction loss on PPI networks
+    # Calculate link prediction loss on PPI networks (packed predictions of all cell types, see PackedBatch): (weighted) sum of the mean loss of every cell type
     ppi_loss = 0
-    for celltype, ppi in ppi_preds.items():
-        ppi_loss += F.binary_cross_entropy(ppi, ppi_y[celltype]["y"].to(device))
+    if len(ppi_preds) > 0:
+        context_loss = calc_ppi_context_loss(ppi_preds, ppi_y)
+        ppi_loss = (context_loss * ppi_weights).sum() if ppi_weights is not None else context_loss.sum()
 
     return ppi_loss, mg_loss
 
 
-def calc_center_loss(center_loss, embed, centers, y, mask):
-    loss = center_loss(embed[mask, :], centers, y[mask].to(device))
+def calc_center_loss(center_loss, embed, centers, y, mask, weights=None):
+    loss = center_loss(embed[mask, :], centers, y[mask].to(device), weights[mask] if weights is not None else None)
     return loss
 
 
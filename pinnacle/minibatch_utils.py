@@ -1,17 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+import queue
 import random
+import threading
 import numpy as np
 import torch
 from torch_geometric.data import Data
-from torch_geometric.loader import NeighborLoader, GraphSAINTRandomWalkSampler, GraphSAINTEdgeSampler
-from torch_geometric.utils import structured_negative_sampling
+from torch_geometric.loader import NeighborLoader, GraphSAINTRandomWalkSampler, GraphSAINTEdgeSampler, GraphSAINTNodeSampler
 
+from partition import load_partition
 from utils import construct_metapath, get_embeddings
-from loss import el_dot, calc_link_pred_loss, calc_center_loss
+from loss import el_dot, calc_link_pred_loss, calc_ppi_context_loss, calc_center_loss
+
+
+class PackedBatch:
+    """
+    Edges of all cell types in one step, packed into a disjoint union. Node :code:`j` of the :code:`i`-th cell type is packed node :code:`node_offsets[i] + j`. Its edges are packed edges :code:`edge_offsets[i]` to :code:`edge_offsets[i + 1]`. Edge predictions, link prediction losses, and center loss labels are computed over the packed tensors of all cell types at once. :code:`split_nodes` and :code:`split_edges` return per-cell type views, e.g. for the cell type specific convolutions.
+
+    :param keys: Cell types, in packing order.
+    :param num_nodes: Number of nodes of every cell type.
+    :param edge_index: List of (2, E_i) edge indices of every cell type, over its own nodes.
+    :param edge_type: List of edge types of every cell type.
+    :param y: List of edge labels of every cell type.
+    :param device: A string indicating the device.
+    """
+    def __init__(self, keys: list, num_nodes: list, edge_index: list, edge_type: list, y: list, device: str):
+        self.keys = list(keys)
+        self.num_nodes = [int(n) for n in num_nodes]
+        self.num_edges = [int(e.shape[1]) for e in edge_index]
+        self.node_offsets = np.append(0, np.cumsum(self.num_nodes))
+        self.edge_offsets = np.append(0, np.cumsum(self.num_edges))
+        self.edge_index = torch.cat([e + int(offset) for e, offset in zip(edge_index, self.node_offsets)], dim=1).to(device)
+        self.edge_type = torch.cat(edge_type).to(device)
+        self.y = torch.cat(y).to(device)
+        self.edge_context = torch.repeat_interleave(torch.arange(len(self.keys)), torch.tensor(self.num_edges, dtype=torch.long)).to(device) # Position of every edge's cell type in keys
+        self.node_key = torch.repeat_interleave(torch.tensor(self.keys, dtype=torch.long), torch.tensor(self.num_nodes, dtype=torch.long)).to(device) # Cell type of every node
+
+    def split_nodes(self, x: torch.Tensor) -> dict:
+        return dict(zip(self.keys, torch.split(x, self.num_nodes)))
+
+    def split_edges(self, e: torch.Tensor) -> dict:
+        return dict(zip(self.keys, torch.split(e, self.num_edges, dim=-1)))
 
 
 def pred_batch2dict(packed_batch: object, mg_x_ori: dict, ppi_x_ori: dict, cell_type_order: list, device: str) -> dict:
     """
-    Re-initialize :code:`ppi_x`, :code:`metagraph`, and transform packed batches of all graphs to a dictionary of batches. Note that different from :code:`train_batch2dict`, we are also re-initializing full :code:`ppi_x` because we are feeding all nodes instead of the sampled nodes in the batch to the model during prediction.
+    Re-initialize :code:`ppi_x`, :code:`metagraph`, and transform packed batches of all graphs to a :class:`PackedBatch` over all nodes of every graph. Note that different from :code:`train_batch2dict`, we are also re-initializing full :code:`ppi_x` because we are feeding all nodes instead of the sampled nodes in the batch to the model during prediction. The model does not modify its inputs, so :code:`ppi_x_init` and :code:`mg_x_init` are the original tensors (moved to :code:`device` if needed) rather than copies.
     
     :param packed_batch: An iterable (tuple if directly following unpacking of the output of :code:`generatePPIBatch`) storing batches of :class:`Data` from all graphs in one round.
     :param mg_x_ori: metagraph original node embeddings.
@@ -19,78 +52,231 @@ def pred_batch2dict(packed_batch: object, mg_x_ori: dict, ppi_x_ori: dict, cell_
     :param cell_type_order: Cell type order.
     :param device: A string indicating the device. Default is "cuda".
     
-    :return: A dictionary of edge data storing batches from all graphs in one round, :code:`ppi_x_batch`, :code:`ppi_node_ind_batch` extracted from batches, and the re-initialized node embeddings :code:`mg_x_init`.
+    :return: :class:`PackedBatch` of the edges of all graphs in one round (over the full :code:`ppi_x` of every graph), and the re-initialized node embeddings :code:`ppi_x_init` and :code:`mg_x_init`.
     """
     # Re-initalize mg_x from mg_x in each batch
-    ppi_x_init = {key: x.clone().to(device) for key, x in ppi_x_ori.items()}
-    mg_x_init = mg_x_ori.clone().to(device) if len(mg_x_ori)!=0 else []
+    ppi_x_init = {key: x.to(device) for key, x in ppi_x_ori.items()}
+    mg_x_init = mg_x_ori.to(device) if len(mg_x_ori)!=0 else []
     
-    # Unpack batches
-    ppi_data_batch = {key: {} for key in cell_type_order}
-    for ind, batch in enumerate(packed_batch):
-        i = cell_type_order[ind]
-        ori_map = batch.n_id
-        ppi_data_batch[i]['total_edge_index'] = ori_map[batch.edge_index].to(device)
-        ppi_data_batch[i]['total_edge_type'] = batch.edge_attr.to(device)
-        ppi_data_batch[i]['y'] = batch.y.to(device)
+    # Pack batches (edges are mapped back to the original node ids)
+    ppi_data_batch = PackedBatch(cell_type_order, [ppi_x_ori[key].shape[0] for key in cell_type_order], [batch.n_id[batch.edge_index] for batch in packed_batch], [batch.edge_attr for batch in packed_batch], [batch.y for batch in packed_batch], device)
     
     return ppi_data_batch, ppi_x_init, mg_x_init
 
 
-def iterate_train_batch(ppi_train_loader_dict: dict, ppi_x_ori: dict, ppi_metapaths_ori: dict, mg_x_ori: dict,  mg_metapaths_train: list, mg_data_train: dict, tissue_neighbors: dict, model: torch.nn.Module, hparams: dict, device: str, wandb: object=None, center_loss: torch.nn.Module=None, optimizer: torch.optim=None, mask_train_ori: list=None) -> tuple:
+class EdgeAccumulator:
+    """
+    Predictions, labels, and edge types of every cell type over the batches of one pass. The edges of every batch are known once it is packed, so :code:`add` only keeps (detached, CPU) views of them, and the first call to :code:`preds` or :code:`labels` writes all batches of a cell type into buffers allocated for exactly their number of edges. Every prediction is copied once, instead of re-concatenating the accumulated tensors on every batch or growing a buffer.
+
+    :param keys: Cell types of the pass.
+    """
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.batches = {key: [] for key in self.keys}
+        self.added = set() # Cell types with at least one batch
+        self.buffers = None
+
+    def add(self, key, pred: torch.Tensor, y: torch.Tensor, edge_type: torch.Tensor):
+        assert self.buffers is None, "Batches added after the predictions were collected"
+        self.batches[key].append((pred.detach().cpu(), y.cpu(), edge_type.cpu()))
+        self.added.add(key)
+
+    def add_packed(self, packed: PackedBatch, pred: torch.Tensor):
+        """
+        Add the packed predictions of all cell types of a :class:`PackedBatch`.
+        """
+        for key, p, y, edge_type in zip(packed.keys, torch.split(pred, packed.num_edges), torch.split(packed.y, packed.num_edges), torch.split(packed.edge_type, packed.num_edges)):
+            self.add(key, p, y, edge_type)
+
+    def collect(self) -> dict:
+        """
+        :return: Dictionary of cell types to their predictions, labels, and edge types over all batches (each in one buffer of the summed batch sizes).
+        """
+        if self.buffers is None:
+            self.buffers = dict()
+            for key in self.keys:
+                batches = self.batches.pop(key)
+                num_edges = np.cumsum([0] + [pred.shape[0] for pred, _, _ in batches])
+                buffers = [torch.empty(int(num_edges[-1]), dtype=dtype) for dtype in [torch.float, torch.float, torch.long]]
+                for start, end, batch in zip(num_edges[:-1], num_edges[1:], batches):
+                    for b, value in zip(buffers, batch): b[start : end].copy_(value)
+                self.buffers[key] = buffers
+        return self.buffers
+
+    def preds(self) -> dict:
+        """
+        :return: Dictionary of cell types (that had batches in the pass) to their predictions.
+        """
+        return {key: buffers[0] for key, buffers in self.collect().items() if key in self.added}
+
+    def labels(self) -> dict:
+        """
+        :return: Dictionary of cell types to their labels (:code:`y`) and edge types (:code:`total_edge_type`).
+        """
+        return {key: {'y': buffers[1], 'total_edge_type': buffers[2]} for key, buffers in self.collect().items()}
+
+
+class PackedBatches:
+    """
+    Packed batches (one batch per context) of a dictionary of loaders, as :code:`(keys, weights, packed_batch)`. Without a scheduler, all loaders are iterated in lockstep (as :code:`zip(*loader_dict.values())`) and :code:`weights` is :code:`None`. With a :class:`ContextScheduler`, every step packs only the contexts drawn by the scheduler, together with the weights of their losses. Loaders of contexts that run out are restarted, for as many steps as the shortest loader has batches, or the scheduler's window if that is longer (so that every context is trained in every pass).
+
+    :param loader_dict: Dictionary of loaders.
+    :param scheduler: Optional :class:`ContextScheduler`.
+    :param workers: Number of threads drawing the batches of the contexts of one step in parallel.
+    """
+    def __init__(self, loader_dict: dict, scheduler: object = None, workers: int = 1):
+        self.loader_dict = loader_dict
+        self.scheduler = scheduler
+        self.workers = workers
+
+    def num_steps(self) -> int:
+        """
+        Number of steps of a pass (loaders run in lockstep, so the shortest loader ends it; with a scheduler, at least one window).
+        """
+        steps = min(len(loader) for loader in self.loader_dict.values())
+        return max(steps, self.scheduler.window) if self.scheduler is not None else steps
+
+    def __iter__(self):
+        pool = ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+        try:
+            if self.scheduler is None:
+                keys = list(self.loader_dict.keys())
+                iterators = [iter(loader) for loader in self.loader_dict.values()]
+                lockstep = zip(*iterators)
+                while True:
+                    packed_batch = tuple(pool.map(next, iterators, [None] * len(iterators))) if pool is not None else next(lockstep, None)
+                    if not packed_batch or any(batch is None for batch in packed_batch): break # Shortest loader is exhausted
+                    yield keys, None, packed_batch
+            else:
+                iterators = dict()
+                def next_batch(key):
+                    batch = next(iterators[key], None) if key in iterators else None
+                    if batch is None: # Start (or restart) the loader of this context
+                        iterators[key] = iter(self.loader_dict[key])
+                        batch = next(iterators[key])
+                    return batch
+                for _ in range(self.num_steps()):
+                    keys, weights = self.scheduler.draw()
+                    packed_batch = tuple(pool.map(next_batch, keys)) if pool is not None else tuple(next_batch(key) for key in keys)
+                    yield keys, weights, packed_batch
+        finally:
+            if pool is not None: pool.shutdown()
+
+
+class BatchPrefetcher:
+    """
+    Iterate packed batches (e.g., :class:`PackedBatches`) in a background thread, assembling every packed batch with :code:`assemble_fn` (e.g., :code:`train_batch2dict`) up to :code:`depth` batches ahead of the consumer. Sampling, unpacking, and metapath construction of the next batches then overlap with the forward and backward pass of the current one. The thread shares the loaders' graph tensors with the main process (no copies).
+
+    Note that the samplers draw from the global random number generator concurrently with the model (e.g., dropout), so prefetched runs are not reproducible batch for batch.
+
+    :param batches: Iterable of packed batches.
+    :param assemble_fn: Function mapping a packed batch to the assembled batch.
+    :param depth: Maximum number of assembled batches waiting in the queue.
+    """
+    def __init__(self, batches, assemble_fn, depth: int = 2):
+        assert depth > 0, "Queue depth must be positive"
+        self.batches = batches
+        self.assemble_fn = assemble_fn
+        self.depth = depth
+
+    def _produce(self, batches: queue.Queue, stop: threading.Event):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        iterator = iter(self.batches)
+        try:
+            for packed_batch in iterator:
+                if stop.is_set() or not put((True, self.assemble_fn(packed_batch))): return
+        except BaseException as e: # Re-raised in the consumer
+            put((False, e))
+            return
+        finally:
+            if hasattr(iterator, "close"): iterator.close()
+        put((False, None))
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                ok, item = batches.get()
+                if not ok:
+                    if item is not None: raise item
+                    break
+                yield item
+        finally: # Also reached if the consumer stops early
+            stop.set()
+            producer.join()
+
+
+def iterate_train_batch(ppi_train_loader_dict: dict, ppi_x_ori: dict, ppi_feat: torch.Tensor, ppi_metapaths_ori: dict, mg_x_ori: dict,  mg_metapaths_train: list, mg_data_train: dict, tissue_neighbors: dict, model: torch.nn.Module, hparams: dict, device: str, wandb: object=None, center_loss: torch.nn.Module=None, optimizer: torch.optim=None, center_loss_mask: object=None, prefetch: int=0, prefetch_workers: int=1, scheduler: object=None) -> tuple:
     """
     Iterate batches for train. In each batch, only embeddings of nodes corresponding to the sampled edges (i.e., sampled nodes and their 2-hop neighbors) are attention-pooled to approximate the global embedding of a cell type's PPI, and used to update the node embedding in CCI. 
+    If :code:`prefetch` is positive, batches are sampled and assembled in a background thread up to :code:`prefetch` batches ahead (see :class:`BatchPrefetcher`). If a :class:`ContextScheduler` is given, every step only trains the contexts it draws, with reweighted link prediction losses and center loss (a weighted mean over the nodes of the drawn contexts, see :class:`PackedBatches`).
     
     :return: :code:`ppi_x_out`, :code:`mg_x`, :code:`mg_pred`, :code:`ppi_preds_all`, :code:`ppi_data_y`, and :code:`total_loss`.
     """
     total_samples = total_loss = 0
-    ppi_preds_all = {}
-    ppi_data_y = {key:{'y': torch.tensor([]), 'total_edge_type': torch.tensor([])} for key in ppi_x_ori.keys()}
+    packed_batches = PackedBatches(ppi_train_loader_dict, scheduler, prefetch_workers)
+    accumulator = EdgeAccumulator(ppi_train_loader_dict.keys())
     ppi_x_out = {key: torch.zeros((x.shape[0], model.output)) for key, x in ppi_x_ori.items()}
     count = 0
 
+    # Unpack batches to edges, nodes, and indices, and reinitialize mg_x
+    assemble_fn = lambda item: (item[0], item[1], train_batch2dict(item[2], mg_x_ori, ppi_metapaths_ori, item[0], device))
+    if prefetch > 0:
+        batches = BatchPrefetcher(packed_batches, assemble_fn, prefetch)
+    else:
+        batches = map(assemble_fn, packed_batches)
+
     # START BATCH FOR LOOP
-    for packed_batch in zip(*ppi_train_loader_dict.values()):
+    for keys, ppi_weights, (ppi_data_batch, ppi_x, ppi_node_ind_batch, ppi_metapaths_batch, _) in batches:
         count += 1
         
         print(f"Training batch {count}")
         optimizer.zero_grad()
         
-        # Unpack batches to edges, nodes, and indices, and reinitialize mg_x
-        ppi_data_batch, ppi_x, ppi_node_ind_batch, ppi_metapaths_batch, _ = train_batch2dict(packed_batch, mg_x_ori, ppi_metapaths_ori, list(ppi_train_loader_dict.keys()), device)
-        batch_size = sum([data['y'].shape[0] for data in ppi_data_batch.values()])  # Number of all samples across all cell types
+        batch_size = ppi_data_batch.y.shape[0]  # Number of all samples across all cell types
         
         # Generate PPI and metagraph embeddings & Compute predictions for metagraph
-        ppi_x, mg_x = model(ppi_x, mg_x_ori, ppi_metapaths_batch, mg_metapaths_train, ppi_data_batch, mg_data_train["total_edge_index"], tissue_neighbors)
+        ppi_x, mg_x = model(ppi_x, mg_x_ori, ppi_metapaths_batch, mg_metapaths_train, ppi_data_batch, mg_data_train["total_edge_index"], tissue_neighbors, ppi_feat)
 
         # Compute predictions for metagraph for train
         mg_pred = el_dot(mg_x, mg_data_train["total_edge_index"], model.mg_relw[mg_data_train["total_edge_type"]])
         
-        # Compute predictions for PPI layers
-        ppi_preds = dict()
+        # Get embeddings
+        embed = torch.cat(list(ppi_x.values())) # Protein (packed)
+        centers = mg_x[0:len(ppi_x_ori)] # Cell type (all, also if a step only trains some of them)
+
+        # Compute predictions for PPI layers (all cell types at once)
+        ppi_preds = el_dot(embed, ppi_data_batch.edge_index, [])
+        accumulator.add_packed(ppi_data_batch, ppi_preds)
         for celltype, x in ppi_x.items():
-            ppi_preds[celltype] = el_dot(x, ppi_data_batch[celltype]['total_edge_index'], [])
-            ppi_preds_all[celltype] = torch.cat([ppi_preds_all.setdefault(celltype, torch.tensor([])), ppi_preds[celltype].detach().cpu()])
-            ppi_data_y[celltype]['y'] = torch.cat([ppi_data_y[celltype]['y'], ppi_data_batch[celltype]['y'].detach().cpu()])
-            ppi_data_y[celltype]['total_edge_type'] = torch.cat([ppi_data_y[celltype]['total_edge_type'], ppi_data_batch[celltype]['total_edge_type'].detach().cpu()])
             ppi_x_out[celltype][ppi_node_ind_batch[celltype]] = x.detach().cpu()
 
         # Compute train loss
-        ppi_loss, mg_loss = calc_link_pred_loss(mg_pred, mg_data_train, ppi_preds, ppi_data_batch, hparams['loss_type'])
+        ppi_loss, mg_loss = calc_link_pred_loss(mg_pred, mg_data_train, ppi_preds, ppi_data_batch, hparams['loss_type'], ppi_weights.to(ppi_preds.device) if ppi_weights is not None else None)
+        if scheduler is not None and scheduler.strategy == "loss":
+            with torch.no_grad(): scheduler.observe(keys, calc_ppi_context_loss(ppi_preds, ppi_data_batch))
         link_loss = hparams['theta'] * ppi_loss + (1 - hparams['theta']) * mg_loss
 
-        # Get embeddings
-        embed = torch.cat(list(ppi_x.values())) # Protein
-        centers = mg_x[0:len(ppi_x)] # Cell type
-
         # Protein labels
-        center_loss_labels = torch.cat([(torch.ones(x.shape[0]) * key).to(torch.long) for key, x in ppi_x.items()])  # Build center loss labels based on batched nodes to ensure consistency with embedding labels
+        center_loss_labels = ppi_data_batch.node_key  # Cell type of every packed node, consistent with the embedding order
 
         # Train mask
-        train_mask = construct_batch_center_loss_mask(mask_train_ori, ppi_node_ind_batch, ppi_x_ori)
+        train_mask = center_loss_mask(ppi_node_ind_batch)
         
         # Center loss
-        cent_loss = calc_center_loss(center_loss, embed, centers, center_loss_labels, train_mask)
+        node_weights = torch.repeat_interleave(ppi_weights, torch.tensor(ppi_data_batch.num_nodes)).to(embed.device) if ppi_weights is not None else None
+        cent_loss = calc_center_loss(center_loss, embed, centers, center_loss_labels, train_mask, node_weights)
         print("Link Prediction: ", link_loss, "Center Loss: ", cent_loss)
         wandb.log({"Link Prediction Loss": link_loss, "Center Loss": cent_loss})
         combined_loss = link_loss + (cent_loss * hparams["lambda"])
@@ -109,68 +295,72 @@ def iterate_train_batch(ppi_train_loader_dict: dict, ppi_x_ori: dict, ppi_metapa
         # Note that here for simplicity the total loss rather than only the link prediction BCEloss is weighted by edge batch size. 
 
     total_loss = total_loss/total_samples  # Weighted total train loss
+    ppi_preds_all, ppi_data_y = accumulator.preds(), accumulator.labels()
     
     return ppi_x_out, mg_x, mg_pred, ppi_preds_all, ppi_data_y, total_loss
     
 
-def iterate_predict_batch(ppi_loader_dict: dict, ppi_x_ori: dict, ppi_metapaths_eval: dict, mg_x_ori: dict,  mg_metapaths: list, mg_data: dict, tissue_neighbors: dict, model: torch.nn.Module, hparams: dict, device: str) -> tuple:
+def iterate_predict_batch(ppi_loader_dict: dict, ppi_x_ori: dict, ppi_feat: torch.Tensor, ppi_metapaths_eval: dict, mg_x_ori: dict,  mg_metapaths: list, mg_data: dict, tissue_neighbors: dict, model: torch.nn.Module, hparams: dict, device: str, chunk_size: int = 1 << 20) -> tuple:
     """
-    Iterate batches for prediction (val/test). To ensure consistent results, the full :code:`ppi_x` is being updated each round with train (for validation), or train & val metapaths (for test), respectively. Minibatching is only performed for edges used for link prediction here to reduce memory cost. Setting val/test batch num to 1 is recommended wherever probable.
+    Iterate batches for prediction (val/test). The full :code:`ppi_x` is updated with train (for validation), or train & val metapaths (for test), respectively. The node embeddings do not depend on the edge batch, so the model runs once per pass, and every batch only gathers and scores its edges in chunks of :code:`chunk_size` edges. Minibatching is only performed for edges used for link prediction here to reduce memory cost.
     
     :return: :code:`ppi_x`, :code:`mg_x`, :code:`mg_pred`, :code:`ppi_preds_all`, and :code:`ppi_data_y`.
     """
-    ppi_preds_all = {}
-    ppi_data_y = {key:{'y':torch.tensor([]), 'total_edge_type':torch.tensor([])} for key in ppi_x_ori.keys()}
+    accumulator = EdgeAccumulator(ppi_loader_dict.keys())
     count = 0
     
     for packed_batch in zip(*ppi_loader_dict.values()):
         count += 1
         
         # Unpack batches and reinitialize mg_x
-        ppi_data_batch, ppi_x, mg_x = pred_batch2dict(packed_batch, mg_x_ori, ppi_x_ori, list(ppi_loader_dict.keys()), device)
-
-        # Generate PPI and metagraph embeddings & Compute predictions for metagraph
-        if mg_data["total_edge_index"] !=  []: mg_data["total_edge_index"] = mg_data["total_edge_index"].to(device)
-        ppi_x, mg_x = get_embeddings(model.to(device), ppi_x, mg_x, ppi_metapaths_eval, mg_metapaths, ppi_data_batch, mg_data["total_edge_index"], tissue_neighbors)
+        ppi_data_batch, ppi_x_init, mg_x_init = pred_batch2dict(packed_batch, mg_x_ori, ppi_x_ori, list(ppi_loader_dict.keys()), device)
 
-        # Compute predictions for metagraph for val/test only once
+        # Generate PPI and metagraph embeddings & Compute predictions for metagraph for val/test only once
         if count == 1:
+            if mg_data["total_edge_index"] !=  []: mg_data["total_edge_index"] = mg_data["total_edge_index"].to(device)
+            ppi_x, mg_x = get_embeddings(model.to(device), ppi_x_init, mg_x_init, ppi_metapaths_eval, mg_metapaths, ppi_data_batch, mg_data["total_edge_index"], tissue_neighbors, ppi_feat.to(device))
             mg_pred = el_dot(mg_x.to(device), mg_data["total_edge_index"], model.mg_relw[mg_data["total_edge_type"]])
+            embed = torch.cat(list(ppi_x.values())).to(device) # Protein (packed)
         
-        # Compute predictions for PPI layers
-        ppi_preds = dict()
-        for celltype, x in ppi_x.items():
-            ppi_preds[celltype] = el_dot(x.to(device), ppi_data_batch[celltype]['total_edge_index'].to(device), [])
-            ppi_preds_all[celltype] = torch.cat([ppi_preds_all.setdefault(celltype, torch.tensor([])), ppi_preds[celltype].detach().cpu()])
-            ppi_data_y[celltype]['y'] = torch.cat([ppi_data_y[celltype]['y'], ppi_data_batch[celltype]['y'].detach().cpu()])
-            ppi_data_y[celltype]['total_edge_type'] = torch.cat([ppi_data_y[celltype]['total_edge_type'], ppi_data_batch[celltype]['total_edge_type'].detach().cpu()])
+        # Compute predictions for PPI layers (all cell types at once, in chunks of edges)
+        num_edges = ppi_data_batch.edge_index.shape[1]
+        ppi_preds = torch.empty(num_edges, device=embed.device)
+        for start in range(0, num_edges, chunk_size):
+            ppi_preds[start : start + chunk_size] = el_dot(embed, ppi_data_batch.edge_index[:, start : start + chunk_size], [])
+        accumulator.add_packed(ppi_data_batch, ppi_preds)
 
-    return ppi_x, mg_x, mg_pred, ppi_preds_all, ppi_data_y
+    return ppi_x, mg_x, mg_pred, accumulator.preds(), accumulator.labels()
     
 
-def construct_batch_center_loss_mask(original_mask: list, ppi_node_ind_batch: dict, ppi_x_ori: dict) -> list:
+class CenterLossMask:
     """
-    Construct the center loss mask for a batch of nodes during training. We first concatenate batched indices across cell types. Note that we must add each index a certain amount correponding to its cell type to represent its position in the concatenated list. We then find the intersection between the indices and the original train mask. The POSITIONS of the matching concatenated batched indices are the mask we want.
-    
-    :param original_mask: The original train mask for nodes for calculating center_loss.
-    :param ppi_node_ind_batch: A dictionary of ppi node indices that are sampled in this minibatch.
+    Center loss train mask over the concatenated nodes of all cell types (in the order of :code:`ppi_x_ori`), stored as a boolean tensor together with the offset of every cell type in the concatenation. For a batch, the mask is a single gather of the batch's concatenated node indices.
+
+    :param original_mask: The original train mask (indices of concatenated nodes) for calculating center_loss.
     :param ppi_x_ori: A dictionary of original :code:`ppi_x`. We need it in order to know the original numbers of PPI nodes of each cell type, and the order of cell types in the original train mask.
-    
-    :return: A list of new train mask for center loss that can be directly applied on the batch center loss labels and the batch labels and the batch embeddings.
-        
+    :param device: A string indicating the device.
     """
-    ppi_size = [x.shape[0] for x in ppi_x_ori.values()]
-    ppi_cum_size = np.append(0, np.cumsum(ppi_size))
-    ppi_node_ind_batch_concat = torch.cat([value + ppi_cum_size[i] for i, value in enumerate(ppi_node_ind_batch.values())]).detach().cpu().numpy()
-    original_mask_set = set(original_mask)
-    train_mask_batch = [i for i, ind in enumerate(ppi_node_ind_batch_concat) if ind in original_mask_set]
-    
-    return train_mask_batch
+    def __init__(self, original_mask, ppi_x_ori: dict, device: str):
+        ppi_size = torch.tensor([x.shape[0] for x in ppi_x_ori.values()], dtype=torch.long)
+        ppi_cum_size = torch.cumsum(ppi_size, 0) - ppi_size
+        self.offsets = {key: int(offset) for key, offset in zip(ppi_x_ori.keys(), ppi_cum_size)}
+        self.train_bool = torch.zeros(int(ppi_size.sum()), dtype=torch.bool)
+        self.train_bool[torch.as_tensor(np.asarray(original_mask), dtype=torch.long)] = True
+        self.train_bool = self.train_bool.to(device)
+
+    def __call__(self, ppi_node_ind_batch: dict) -> torch.Tensor:
+        """
+        :param ppi_node_ind_batch: A dictionary of ppi node indices that are sampled in this minibatch.
+
+        :return: Boolean train mask for center loss that can be directly applied on the batch center loss labels and the batch embeddings (concatenated in the same order).
+        """
+        ppi_node_ind_batch_concat = torch.cat([value + self.offsets[key] for key, value in ppi_node_ind_batch.items()])
+        return self.train_bool[ppi_node_ind_batch_concat.to(self.train_bool.device)]
     
 
 def train_batch2dict(packed_batch: object, mg_x_ori: dict, ppi_metapaths: dict, cell_type_order: list, device: str) -> dict:
     """
-    Re-initialize :code:`metagraph`, and transform packed batches of all graphs to a dictionary of batches.
+    Re-initialize :code:`metagraph`, and transform packed batches of all graphs to a :class:`PackedBatch`.
     
     :param packed_batch: An iterable (tuple if directly following unpacking of the output of :code:`generatePPIBatch`) storing batches of :class:`Data` from all graphs in one round.
     :param mg_x_ori: metagraph original node embeddings.
@@ -178,113 +368,413 @@ def train_batch2dict(packed_batch: object, mg_x_ori: dict, ppi_metapaths: dict,
     :param cell_type_order: Cell type order.
     :param device: A string indicating the device. Default is "cuda".
     
-    :return: A dictionary of edge data from all graphs in one round, :code:`ppi_x_batch`, :code:`ppi_node_ind_batch` and :code:`ppi_metapaths_batch` extracted from batches, and the re-initialized node embeddings :code:`mg_x_init`.
+    :return: :class:`PackedBatch` of the edges of all graphs in one round, :code:`ppi_x_batch`, :code:`ppi_node_ind_batch` and :code:`ppi_metapaths_batch` extracted from batches (per-graph views of packed tensors, except for metapaths), and the re-initialized node embeddings :code:`mg_x_init`.
     """
     # Re-initalize mg_x from mg_x in each batch
     # ppi_x_init = {key:x.clone().to(device) for key, x in ppi_x.items()}
     # mg_x_init = mg_x_ori.clone().to(device) if len(mg_x_ori)!=0 else []
     
-    # Unpack batches
-    ppi_data_batch = {key:{} for key in cell_type_order}
-    ppi_x_batch = {}
-    ppi_node_ind_batch = {}
+    # Pack batches (one transfer to device per field)
+    ppi_data_batch = PackedBatch(cell_type_order, [batch.num_nodes for batch in packed_batch], [batch.edge_index for batch in packed_batch], [batch.edge_attr for batch in packed_batch], [batch.y for batch in packed_batch], device)
+    ppi_node_ind_batch = ppi_data_batch.split_nodes(torch.cat([batch.n_id for batch in packed_batch]).to(device))
+    ppi_x_batch = ppi_data_batch.split_nodes(torch.cat([batch.x_index for batch in packed_batch]).to(device))
     ppi_metapaths_out = {}
     for ind, batch in enumerate(packed_batch):
-        # ori_map = batch.n_id
-        # batch.total_edge_index = ori_map[batch.edge_index]
         i = cell_type_order[ind]
-        ppi_node_ind_batch[i] = batch.n_id.to(device)
-        ppi_x_batch[i] = batch.x.to(device)
-        ppi_data_batch[i]['total_edge_index'] = batch.edge_index.to(device)
-        ppi_data_batch[i]['total_edge_type'] = batch.edge_attr.to(device)
-        ppi_data_batch[i]['y'] = batch.y.to(device)
         
         # Metapath adjs
-        ppi_metapaths_batch = construct_metapath(ppi_metapaths, batch.edge_index[:, batch.y.type(torch.bool)], batch.edge_attr[batch.y.type(torch.bool)], batch.x.shape[0])
+        ppi_metapaths_batch = construct_metapath(ppi_metapaths, batch.edge_index[:, batch.y.type(torch.bool)], batch.edge_attr[batch.y.type(torch.bool)], batch.num_nodes)
         
         ppi_metapaths_out[i] = [ppi_metapaths_batch[0].to(device)]
     
     return ppi_data_batch, ppi_x_batch, ppi_node_ind_batch, ppi_metapaths_out, []#, mg_x_init
 
 
-def generate_batch(data_dict, metapaths, edge_attr_dict, mask, batch_size, device, ppi=False, loader_type="graphsaint", num_layers=2):
-    masked_data_dict = dict()
-    metapath_adjs_dict = dict()
-    x_dict = dict()
-    loader_dict = {}
+class ClusterLoader:
+    """
+    Minibatches of a graph over a fixed node partition (see :code:`partition.py`). The partitions are shuffled into groups of at most :code:`parts_per_batch`, and every batch holds the nodes of one group. Batches have the same attributes as those of the GraphSAINT loaders, and every loader of a set of graphs yields :code:`num_batches` batches per epoch, so that loaders iterated in lockstep cover all of their graphs (like the :code:`num_steps` of GraphSAINT).
 
-    # Iterate through subnetworks
-    for key, data in data_dict.items():
-        
-        # Positive edges
-        if mask == "train":
-            pos_edge_index = data.edge_index[:, data.train_mask]
-            edge_type = data.edge_attr[data.train_mask]
-        elif mask == "val":
-            pos_edge_index = data.edge_index[:, data.val_mask] 
-            edge_type = data.edge_attr[data.val_mask] 
-        elif mask == "test":
-            pos_edge_index = data.edge_index[:, data.test_mask] 
-            edge_type = data.edge_attr[data.test_mask]
-        else:
-            pos_edge_index = data.edge_index
-            edge_type = data.edge_attr
-        
-        # Negative edges
-        neg_edge_index, neg_edge_type = negative_sampler(pos_edge_index, edge_type, edge_attr_dict)
-        
-        # All edges and labels
-        total_edge_index = torch.cat([pos_edge_index, neg_edge_index], dim=-1) 
-        total_edge_type = torch.cat([edge_type, neg_edge_type], dim=-1)
-        y = torch.zeros(total_edge_index.size(1)).float() 
-        y[:pos_edge_index.size(1)] = 1
+    For training (:code:`cut_edges`), a batch only holds the positive edges within its group (edges between groups are cut, as in Cluster-GCN, and are trained whenever their partitions share a group) and as many negatives with a source in the group, whose destinations outside the group are redrawn among the group's nodes. A batch thus never grows beyond the nodes of its group. Graphs with fewer groups than :code:`num_batches` are reshuffled and cycled until the epoch ends.
 
-        # Metapath adjs
-        metapath_adjs_dict[key] = construct_metapath(metapaths, pos_edge_index, edge_type, data.x.size(0))
-
-        # Save information
-        x_dict[key] = data.x.to(device)
-        masked_data_dict[key] = dict()
-        if ppi:
-            data = Data(x = data.x, edge_index = total_edge_index, edge_attr = total_edge_type, y = y)
-            data.n_id = torch.arange(data.num_nodes)
-            if loader_type == "neighbor":
-                loader = NeighborLoader(data, num_neighbors = [-1] * num_layers, batch_size = batch_size, input_nodes = torch.arange(data.num_nodes), shuffle = True)
-            elif loader_type == "graphsaint":
-                #loader = GraphSAINTRandomWalkSampler(data, batch_size = batch_size, walk_length = num_layers)
-                loader = GraphSAINTEdgeSampler(data, batch_size = batch_size, num_steps = 16)
+    Otherwise (prediction), every edge (positive or negative) is in exactly one batch per epoch: the partitions are spread over :code:`num_batches` groups (some of which may be empty), and a batch holds every edge whose source is in its group, together with the edge destinations outside the group (the model embeds the full graph for prediction, so the batch size does not matter there).
+
+    :param data: :class:`Data` with :code:`x_index`, :code:`edge_index`, :code:`edge_attr`, and :code:`y`.
+    :param parts: Partition of every node (numbered consecutively from 0).
+    :param parts_per_batch: Maximum number of partitions per batch.
+    :param num_batches: Number of batches per epoch (default: the number of groups of the graph's partitions).
+    :param cut_edges: If :code:`True`, batches only hold edges within their group (training).
+    :param max_tries: Number of rounds redrawing negatives that hit a positive edge of the group (after which they are kept).
+    """
+    def __init__(self, data: Data, parts: np.ndarray, parts_per_batch: int, num_batches: int = None, cut_edges: bool = False, max_tries: int = 10):
+        self.data = data
+        self.parts = np.asarray(parts, dtype=np.int64)
+        self.num_parts = int(self.parts.max()) + 1 if len(self.parts) > 0 else 0
+        self.parts_per_batch = parts_per_batch
+        self.num_groups = -(-self.num_parts // parts_per_batch)
+        self.num_batches = num_batches if num_batches is not None else self.num_groups
+        assert self.num_batches >= self.num_groups, "%d batches cannot hold %d partitions in groups of %d" % (self.num_batches, self.num_parts, parts_per_batch)
+        self.cut_edges = cut_edges
+        self.max_tries = max_tries
+        self.pos = data.y == 1
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        if self.num_groups == 0: return
+        if not self.cut_edges:
+            yield from self.epoch(self.num_batches)
+            return
+        count = 0
+        while True: # Cycle reshuffled groups until the epoch has num_batches batches
+            for batch in self.epoch(self.num_groups):
+                if count == self.num_batches: return
+                count += 1
+                yield batch
+
+    def epoch(self, num_groups: int):
+        """
+        Batches of one shuffle of the partitions into :code:`num_groups` groups (of sizes differing by at most one partition).
+        """
+        batch_of_part = np.empty(self.num_parts, dtype=np.int64)
+        batch_of_part[torch.randperm(self.num_parts).numpy()] = np.arange(self.num_parts) % num_groups
+        node_batch = batch_of_part[self.parts]
+
+        # Nodes of every group, and edges by the group of their source, sorted by batch (counting sort)
+        node_order = torch.from_numpy(np.argsort(node_batch, kind="stable"))
+        node_ptr = np.append(0, np.cumsum(np.bincount(node_batch, minlength=num_groups)))
+        edge_batch = node_batch[self.data.edge_index[0].numpy()]
+        edge_order = torch.from_numpy(np.argsort(edge_batch, kind="stable"))
+        edge_ptr = np.append(0, np.cumsum(np.bincount(edge_batch, minlength=num_groups)))
+        node_batch = torch.from_numpy(node_batch)
+        local = torch.empty(len(node_batch), dtype=torch.long) # Position of every node within the current batch
+
+        for b in range(num_groups):
+            group = node_order[node_ptr[b] : node_ptr[b + 1]]
+            e_id = edge_order[edge_ptr[b] : edge_ptr[b + 1]]
+            if self.cut_edges:
+                yield self.cut_batch(group, e_id, node_batch[self.data.edge_index[1, e_id]] == b, local)
+                continue
+            dst = self.data.edge_index[1, e_id]
+            n_id = torch.cat([group, torch.unique(dst[node_batch[dst] != b])]) # Group nodes, then destinations outside the group
+            local[n_id] = torch.arange(len(n_id))
+            yield Data(x_index = self.data.x_index[n_id], n_id = n_id, edge_index = local[self.data.edge_index[:, e_id]], edge_attr = self.data.edge_attr[e_id], y = self.data.y[e_id], num_nodes = len(n_id))
+
+    def cut_batch(self, group: torch.Tensor, e_id: torch.Tensor, in_group: torch.Tensor, local: torch.Tensor) -> Data:
+        """
+        Batch of the nodes of one group: the positive edges within the group, and as many of the negatives with a source in the group, with their destinations inside the group.
+
+        :param group: Nodes of the group.
+        :param e_id: Edges whose source is in the group.
+        :param in_group: Whether the destination of every edge in :code:`e_id` is in the group.
+        :param local: Buffer for the position of every node within the batch.
+        """
+        n = len(group)
+        local[group] = torch.arange(n)
+        pos = self.pos[e_id]
+        pos_id = e_id[pos & in_group]
+        neg = torch.nonzero(~pos).view(-1)
+        neg = neg[torch.randperm(len(neg))[ : len(pos_id)]]
+        neg_id, redraw = e_id[neg], ~in_group[neg]
+
+        # Negatives: keep destinations in the group, redraw the others among the group's nodes (avoiding the group's positive edges)
+        pos_edge_index = local[self.data.edge_index[:, pos_id]]
+        neg_edge_index = self.data.edge_index[:, neg_id].clone()
+        neg_edge_index[0] = local[neg_edge_index[0]]
+        neg_edge_index[1, ~redraw] = local[neg_edge_index[1, ~redraw]]
+        pos_keys = np.sort((pos_edge_index[0] * n + pos_edge_index[1]).numpy())
+        for _ in range(self.max_tries):
+            idx = torch.nonzero(redraw).view(-1)
+            if len(idx) == 0: break
+            neg_edge_index[1, idx] = torch.randint(n, (len(idx), ))
+            keys = (neg_edge_index[0, idx] * n + neg_edge_index[1, idx]).numpy()
+            hit = NegativeSampler.contains(pos_keys, keys) | (neg_edge_index[0, idx] == neg_edge_index[1, idx]).numpy()
+            redraw[:] = False
+            redraw[idx[torch.from_numpy(hit)]] = True
+
+        e_id = torch.cat([pos_id, neg_id])
+        return Data(x_index = self.data.x_index[group], n_id = group, edge_index = torch.cat([pos_edge_index, neg_edge_index], dim=1), edge_attr = self.data.edge_attr[e_id], y = self.data.y[e_id], num_nodes = n)
+
+
+class TrimNodes:
+    """
+    Trim a neighbor-sampled batch to at most :code:`budget` nodes. Sampled nodes are ordered by hop (seeds first), so the batch keeps its seeds and the nodes closest to them, and drops the edges to the nodes cut off (e.g., the last hop around a hub).
+
+    :param budget: Maximum number of nodes per batch (at least the number of seeds).
+    """
+    def __init__(self, budget: int):
+        self.budget = budget
+
+    def __call__(self, batch: Data) -> Data:
+        if batch.num_nodes <= self.budget: return batch
+        kept = (batch.edge_index < self.budget).all(dim=0)
+        batch.edge_index = batch.edge_index[:, kept]
+        for key in ["edge_attr", "y", "e_id"]:
+            if key in batch: batch[key] = batch[key][kept]
+        for key in ["x_index", "n_id"]:
+            if key in batch: batch[key] = batch[key][ : self.budget]
+        batch.num_nodes = self.budget
+        return batch
+
+
+NEIGHBOR_DEFAULTS = {"fanouts": None, "node_budget": 0}
+CLUSTER_DEFAULTS = {"cluster_size": 128, "parts_per_batch": 4, "save_dir": None}
+SAINT_DEFAULTS = {"sampler": "edge", "num_steps": 16, "walk_length": 2}
+
+
+class BatchGenerator:
+    """
+    Minibatch generator for one split (:code:`mask`) of a set of graphs. Everything that does not change between epochs (positive edges, labels, edge types, metapath adjacencies, and node features) is built once; every call to :code:`resample` only draws new negative edges and wraps them in new loaders.
+
+    :param data_dict: Dictionary of :class:`Data` objects (PPI layers, or :code:`{0: mg_data}` for the metagraph).
+    :param metapaths: Metapaths to construct adjacencies for.
+    :param edge_attr_dict: Dictionary of relation names to edge types.
+    :param mask: Split of the positive edges (:code:`train`, :code:`val`, :code:`test`, or :code:`all`).
+    :param batch_size: Batch size of the loaders.
+    :param device: A string indicating the device.
+    :param ppi: If :code:`True`, the edges of every graph are minibatched with a loader (PPI layers); otherwise all edges are kept on :code:`device` (metagraph).
+    :param loader_type: Loader for minibatching (:code:`graphsaint`, :code:`neighbor`, or :code:`cluster`).
+    :param num_layers: Number of model layers, i.e., hops sampled by the :code:`neighbor` loader.
+    :param true_negatives: If :code:`True`, negatives are also redrawn if they are edges of the graph in any split (see :class:`NegativeSampler`).
+    :param saint_args: Options of the :code:`graphsaint` loader (see :code:`SAINT_DEFAULTS`): sampler kind (:code:`edge`, :code:`node`, or :code:`random_walk`), number of batches per epoch, and walk length. Batches are not normalized (no sample coverage): negatives are redrawn every epoch, so coefficients estimated on one epoch's edges would not apply to the next.
+    :param neighbor_args: Options of the :code:`neighbor` loader (see :code:`NEIGHBOR_DEFAULTS`): number of neighbors sampled per hop (one per layer; :code:`-1`: all; default: all neighbors), and maximum number of nodes per batch (0: no budget, see :class:`TrimNodes`).
+    :param cluster_args: Options of the :code:`cluster` loader (see :code:`CLUSTER_DEFAULTS`): target number of nodes per partition, maximum number of partitions per batch, and directory to cache the partitions in. Every graph is partitioned on its train edges, so all splits share its partitions. All graphs get as many batches as the graph with the most partitions, and only the train split cuts the edges between groups (see :class:`ClusterLoader`).
+    """
+    def __init__(self, data_dict, metapaths, edge_attr_dict, mask, batch_size, device, ppi=False, loader_type="graphsaint", num_layers=2, true_negatives=False, saint_args=None, cluster_args=None, neighbor_args=None):
+        self.saint_args = dict(SAINT_DEFAULTS, **(saint_args or {}))
+        self.neighbor_args = dict(NEIGHBOR_DEFAULTS, **(neighbor_args or {}))
+        self.cluster_args = dict(CLUSTER_DEFAULTS, **(cluster_args or {}))
+        self.parts = dict()
+        self.edge_attr_dict = edge_attr_dict
+        self.batch_size = batch_size
+        self.device = device
+        self.ppi = ppi
+        self.loader_type = loader_type
+        self.num_layers = num_layers
+        self.mask = mask
+        assert self.neighbor_args["fanouts"] is None or len(self.neighbor_args["fanouts"]) == num_layers, "%d fanouts given for a model with %d layers" % (len(self.neighbor_args["fanouts"]), num_layers)
+        assert self.neighbor_args["node_budget"] <= 0 or self.neighbor_args["node_budget"] >= batch_size, "The node budget (%d) must leave room for the seed nodes of a batch (%d)" % (self.neighbor_args["node_budget"], batch_size)
+        self.pos_edge_index = dict()
+        self.edge_type = dict()
+        self.total_edge_type = dict()
+        self.y = dict()
+        self.x_index = dict()
+        self.num_nodes = dict()
+        self.metapath_adjs_dict = dict()
+        self.x_dict = dict()
+
+        # Iterate through subnetworks
+        for key, data in data_dict.items():
+
+            # Positive edges
+            if mask == "train":
+                pos_edge_index = data.edge_index[:, data.train_mask]
+                edge_type = data.edge_attr[data.train_mask]
+            elif mask == "val":
+                pos_edge_index = data.edge_index[:, data.val_mask] 
+                edge_type = data.edge_attr[data.val_mask] 
+            elif mask == "test":
+                pos_edge_index = data.edge_index[:, data.test_mask] 
+                edge_type = data.edge_attr[data.test_mask]
             else:
-                raise NotImplementedError
+                pos_edge_index = data.edge_index
+                edge_type = data.edge_attr
+            self.pos_edge_index[key] = pos_edge_index
+            self.edge_type[key] = edge_type
 
-            loader_dict[key] = loader
-            masked_data_dict[key]["total_edge_type"] = total_edge_type
-        else:
-            masked_data_dict[key]["total_edge_index"] = total_edge_index.to(device)
-            masked_data_dict[key]["total_edge_type"] = total_edge_type.to(device)
-            masked_data_dict[key]["y"] = y.to(device)
+            # Edge types and labels (one negative per positive edge, grouped by relation in the order of NegativeSampler)
+            neg_edge_type = torch.cat([edge_type[edge_type == idx] for idx in edge_attr_dict.values()]) if len(edge_type) > 0 else edge_type
+            total_edge_type = torch.cat([edge_type, neg_edge_type], dim=-1)
+            y = torch.zeros(total_edge_type.size(0)).float() 
+            y[:pos_edge_index.size(1)] = 1
+            self.total_edge_type[key] = total_edge_type if ppi else total_edge_type.to(device)
+            self.y[key] = y if ppi else y.to(device)
 
-    return loader_dict, masked_data_dict, metapath_adjs_dict, x_dict
+            # Metapath adjs
+            self.metapath_adjs_dict[key] = construct_metapath(metapaths, pos_edge_index, edge_type, data.num_nodes)
 
+            # Save information (PPI layers carry row indices into the model's shared feature table instead of features)
+            x = data.x if data.x is not None else data.x_index
+            self.x_dict[key] = x.to(device)
+            self.x_index[key] = data.x_index if ppi else None
+            self.num_nodes[key] = data.num_nodes
 
-def negative_sampler(pos_edge_index, edge_type, edge_attr_dict):
-    if len(edge_type) == 0: return pos_edge_index, edge_type
-    neg_edge_index = None 
-    neg_edge_type = []
-    for attr, idx in edge_attr_dict.items():
-        mask = (edge_type == idx)
-        if mask.sum() == 0: continue
-        pos_rel_edge_index = pos_edge_index.T[mask].T        
-        neg_source, neg_target, neg_rand = structured_negative_sampling(pos_rel_edge_index)
-        neg_rel_edge_index = torch.stack((neg_source, neg_rand), dim = 0)
+            # Node partition of the graph (train edges)
+            if ppi and loader_type == "cluster":
+                num_parts = -(-data.num_nodes // self.cluster_args["cluster_size"])
+                self.parts[key] = load_partition(data.edge_index[:, data.train_mask].numpy(), data.num_nodes, num_parts, self.cluster_args["save_dir"], "partition_%s" % key)
+        self.cluster_batches = max([-(-(int(parts.max()) + 1) // self.cluster_args["parts_per_batch"]) for parts in self.parts.values() if len(parts) > 0] + [0]) # Same number of batches for all graphs
+
+        # Negatives of all graphs are drawn in one pass
+        self.negative_sampler = NegativeSampler(self.pos_edge_index, self.edge_type, edge_attr_dict, {key: data.edge_index for key, data in data_dict.items()} if true_negatives else None)
+
+    def resample(self):
         """
-        neg_rel_edge_index = pos_rel_edge_index.clone()
-        rand_axis = random.sample([0, 1], 1)[0]
-        rand_index = torch.randperm(pos_rel_edge_index.size(1))
-        neg_rel_edge_index[rand_axis, :] = pos_rel_edge_index[rand_axis, rand_index]
+        Draw new negative edges for every graph.
+
+        :return: Dictionary of loaders (PPI layers), dictionary of edge data, dictionary of metapath adjacencies, and dictionary of node features (or feature row indices), in the same format as :code:`generate_batch`.
         """
-        if neg_edge_index == None: neg_edge_index = neg_rel_edge_index 
-        else: neg_edge_index = torch.cat((neg_edge_index, neg_rel_edge_index), 1) 
-        
-        neg_edge_type.extend([idx] * mask.sum())
+        masked_data_dict = dict()
+        loader_dict = {}
+        neg_edge_index_dict = self.negative_sampler.sample()
+        for key, pos_edge_index in self.pos_edge_index.items():
+
+            # Negative edges
+            total_edge_index = torch.cat([pos_edge_index, neg_edge_index_dict[key].to(pos_edge_index.dtype)], dim=-1) 
+
+            masked_data_dict[key] = dict()
+            if self.ppi:
+                data = Data(x_index = self.x_index[key], edge_index = total_edge_index, edge_attr = self.total_edge_type[key], y = self.y[key], num_nodes = self.num_nodes[key])
+                data.n_id = torch.arange(data.num_nodes)
+                if self.loader_type == "neighbor":
+                    loader = self.neighbor_loader(data)
+                elif self.loader_type == "graphsaint":
+                    loader = self.saint_loader(data)
+                elif self.loader_type == "cluster":
+                    loader = ClusterLoader(data, self.parts[key], self.cluster_args["parts_per_batch"], self.cluster_batches, cut_edges = self.mask == "train")
+                else:
+                    raise NotImplementedError
+
+                loader_dict[key] = loader
+                masked_data_dict[key]["total_edge_type"] = self.total_edge_type[key]
+            else:
+                masked_data_dict[key]["total_edge_index"] = total_edge_index.to(self.device)
+                masked_data_dict[key]["total_edge_type"] = self.total_edge_type[key]
+                masked_data_dict[key]["y"] = self.y[key]
 
-    return neg_edge_index, torch.tensor(neg_edge_type)
\ No newline at end of file
+        return loader_dict, masked_data_dict, self.metapath_adjs_dict, self.x_dict
+
+    def neighbor_loader(self, data):
+        """
+        Neighbor loader of one graph with per-hop fanouts. With a node budget, every batch is trimmed to the budget after sampling (see :class:`TrimNodes`), so all graphs keep the same number of seeds per batch.
+        """
+        fanouts = list(self.neighbor_args["fanouts"] or [-1] * self.num_layers)
+        transform = TrimNodes(self.neighbor_args["node_budget"]) if self.neighbor_args["node_budget"] > 0 else None
+        return NeighborLoader(data, num_neighbors = fanouts, batch_size = self.batch_size, input_nodes = torch.arange(data.num_nodes), shuffle = True, transform = transform)
+
+    def saint_loader(self, data):
+        """
+        GraphSAINT loader of one graph.
+        """
+        kwargs = dict(batch_size = self.batch_size, num_steps = self.saint_args["num_steps"], sample_coverage = 0, log = False)
+        if self.saint_args["sampler"] == "edge":
+            return GraphSAINTEdgeSampler(data, **kwargs)
+        elif self.saint_args["sampler"] == "node":
+            return GraphSAINTNodeSampler(data, **kwargs)
+        elif self.saint_args["sampler"] == "random_walk":
+            return GraphSAINTRandomWalkSampler(data, walk_length = self.saint_args["walk_length"], **kwargs)
+        raise NotImplementedError
+
+
+def generate_batch(data_dict, metapaths, edge_attr_dict, mask, batch_size, device, ppi=False, loader_type="graphsaint", num_layers=2, true_negatives=False, saint_args=None, cluster_args=None, neighbor_args=None):
+    # One-off batches (use a persistent BatchGenerator to resample negatives every epoch)
+    return BatchGenerator(data_dict, metapaths, edge_attr_dict, mask, batch_size, device, ppi, loader_type, num_layers, true_negatives, saint_args, cluster_args, neighbor_args).resample()
+
+
+class NegativeSampler:
+    """
+    Structured negative sampling of all relations of a set of graphs in one vectorized pass. For every positive edge :code:`(i, j)` of relation :code:`r`, a negative edge :code:`(i, k)` is drawn with :code:`k` uniform over the nodes of relation :code:`r` in the same graph (i.e., :code:`[0, max node id of r + 1)`), and redrawn while :code:`(i, k)` is a positive edge of :code:`r`. This is the same as calling :code:`structured_negative_sampling` per graph and relation, but the edges of all graphs and relations are corrupted at once (relations and graphs are kept apart by offsetting their edge keys).
+
+    :param pos_edge_index_dict: Dictionary of graph keys to their positive edges.
+    :param edge_type_dict: Dictionary of graph keys to the edge types of their positive edges.
+    :param edge_attr_dict: Dictionary of relation names to edge types. The negatives of a graph are grouped by relation in this order.
+    :param exclude_edge_index_dict: Optional dictionary of graph keys to all of their known edges (e.g., of every split and relation). If given, negatives that match any of these edges in either direction are also redrawn, so that every negative is a true non-edge of its graph.
+    :param max_tries: Number of redraw rounds after which negatives that only collide with :code:`exclude_edge_index_dict` are kept (e.g., sources adjacent to every candidate node).
+    """
+    def __init__(self, pos_edge_index_dict: dict, edge_type_dict: dict, edge_attr_dict: dict, exclude_edge_index_dict: dict = None, max_tries: int = 100):
+        rel_types = list(edge_attr_dict.values())
+        rank = np.full(max(rel_types) + 1, -1, dtype=np.int64) # Edge type -> position of its relation in edge_attr_dict
+        rank[rel_types] = np.arange(len(rel_types))
+
+        # Group the positive edges of every graph by relation (graph i, relation r -> group i * R + r)
+        self.keys = list(pos_edge_index_dict)
+        src, dst, group, sizes = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], []
+        for i, key in enumerate(self.keys):
+            pos_edge_index = pos_edge_index_dict[key].cpu().numpy().astype(np.int64)
+            rel = rank[edge_type_dict[key].cpu().numpy()] if pos_edge_index.shape[1] > 0 else np.zeros(0, dtype=np.int64)
+            assert (rel >= 0).all(), "Edge types missing from edge_attr_dict"
+            order = np.argsort(rel, kind="stable")
+            src.append(pos_edge_index[0, order])
+            dst.append(pos_edge_index[1, order])
+            group.append(i * len(rel_types) + rel[order])
+            sizes.append(len(rel))
+        src, dst, group = np.concatenate(src), np.concatenate(dst), np.concatenate(group)
+        self.offsets = np.append(0, np.cumsum(sizes))
+        self.src = torch.from_numpy(src.astype(np.int32))
+
+        # Number of nodes per group (max node id + 1)
+        starts = np.flatnonzero(np.diff(group, prepend=-1))
+        num_group_nodes = np.maximum.reduceat(np.maximum(src, dst), starts) + 1 if len(starts) > 0 else np.zeros(0, dtype=np.int64)
+        high = np.repeat(num_group_nodes, np.diff(np.append(starts, len(group))))
+        self.num_nodes = int(high.max()) if len(high) > 0 else 1
+        if exclude_edge_index_dict is not None:
+            self.num_nodes = max([self.num_nodes] + [int(exclude_edge_index_dict[key].max()) + 1 for key in self.keys if exclude_edge_index_dict[key].numel() > 0])
+
+        # Edges are sampled in (group, source) order so that lookups of consecutive negatives hit nearby positive keys
+        self.order = np.argsort(group * self.num_nodes + src, kind="stable")
+        self.sorted_src = src[self.order]
+        self.sorted_group = group[self.order]
+        self.sorted_high = torch.from_numpy(high[self.order]).double()
+        self.pos_keys = np.sort(self.edge_keys(group, src, dst)) # Sorted once
+
+        # Keys of all known edges of every graph, in both directions (any relation)
+        self.num_rel = len(rel_types)
+        self.max_tries = max_tries
+        self.exclude_keys = None
+        if exclude_edge_index_dict is not None:
+            exclude_keys = [np.zeros(0, dtype=np.int64)]
+            for i, key in enumerate(self.keys):
+                u, v = exclude_edge_index_dict[key].cpu().numpy().astype(np.int64)
+                exclude_keys += [self.edge_keys(i, u, v), self.edge_keys(i, v, u)]
+            self.exclude_keys = np.sort(np.concatenate(exclude_keys))
+
+    def edge_keys(self, group: np.ndarray, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        """
+        Unique int64 key of an edge within its graph and relation.
+        """
+        return (group * self.num_nodes + src) * self.num_nodes + dst
+
+    @staticmethod
+    def contains(sorted_keys: np.ndarray, keys: np.ndarray) -> np.ndarray:
+        """
+        Membership of :code:`keys` in a sorted key array.
+        """
+        if len(sorted_keys) == 0: return np.zeros(len(keys), dtype=bool)
+        pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        return sorted_keys[pos] == keys
+
+    def is_rejected(self, group: np.ndarray, src: np.ndarray, dst: np.ndarray, exclude: bool = True) -> np.ndarray:
+        """
+        Whether the negatives :code:`(src, dst)` of the given groups are positive edges of their relation (or, if :code:`exclude`, known edges of their graph).
+        """
+        rejected = self.contains(self.pos_keys, self.edge_keys(group, src, dst))
+        if exclude and self.exclude_keys is not None:
+            rejected |= self.contains(self.exclude_keys, self.edge_keys(group // self.num_rel, src, dst))
+        return rejected
+
+    def sample(self, generator: torch.Generator = None) -> dict:
+        """
+        :param generator: Random number generator (default: the global generator).
+
+        :return: Dictionary of graph keys to their (2, E) int32 negative edges (views into one buffer holding the negatives of all graphs).
+        """
+        rand = (torch.rand(len(self.sorted_high), generator=generator, dtype=torch.float64) * self.sorted_high).long().numpy()
+        rest = np.flatnonzero(self.is_rejected(self.sorted_group, self.sorted_src, rand))
+        tries = 0
+        while len(rest) > 0: # Redraw only the rejected negatives
+            tries += 1
+            rand[rest] = (torch.rand(len(rest), generator=generator, dtype=torch.float64) * self.sorted_high[rest]).long().numpy()
+            rest = rest[self.is_rejected(self.sorted_group[rest], self.sorted_src[rest], rand[rest], exclude=tries < self.max_tries)]
+
+        neg_edge_index = torch.empty((2, len(rand)), dtype=torch.int32)
+        neg_edge_index[0] = self.src
+        neg_edge_index[1, torch.from_numpy(self.order)] = torch.from_numpy(rand.astype(np.int32))
+        return {key: neg_edge_index[:, self.offsets[i] : self.offsets[i + 1]] for i, key in enumerate(self.keys)}
+
+
+def negative_sampler(pos_edge_index, edge_type, edge_attr_dict):
+    # Negatives of a single graph (see NegativeSampler)
+    if len(edge_type) == 0: return pos_edge_index, edge_type
+    neg_edge_index = NegativeSampler({0: pos_edge_index}, {0: edge_type}, edge_attr_dict).sample()[0].long()
+    neg_edge_type = torch.cat([edge_type[edge_type == idx] for idx in edge_attr_dict.values()])
+    return neg_edge_index, neg_edge_type
@@ -7,7 +7,7 @@ from conv import PCTConv, PPIConv
 
 
 class Pinnacle(nn.Module):
-    def __init__(self, nfeat, hidden, output, num_ppi_relations, num_mg_relations, ppi_data, n_heads, pc_att_channels, dropout = 0.2):
+    def __init__(self, nfeat, hidden, output, num_ppi_relations, num_mg_relations, ppi_data, n_heads, pc_att_channels, dropout = 0.2, tissue_update = 100, tissue_tol = 0.0):
         super(Pinnacle, self).__init__()
 
         self.dropout = dropout
@@ -20,7 +20,7 @@ class Pinnacle(nn.Module):
         self.output = self.layer2_out * n_heads
 
         # Complete layer #1
-        self.conv1_up = PCTConv(self.layer1_in, num_ppi_relations, num_mg_relations, ppi_data, self.layer1_out, sem_att_channels=8, pc_att_channels=pc_att_channels, node_heads=n_heads)
+        self.conv1_up = PCTConv(self.layer1_in, num_ppi_relations, num_mg_relations, ppi_data, self.layer1_out, sem_att_channels=8, pc_att_channels=pc_att_channels, node_heads=n_heads, tissue_update=tissue_update, tissue_tol=tissue_tol)
         self.conv1_down = PPIConv(self.layer1_out * n_heads, num_ppi_relations, self.layer1_out, ppi_data, sem_att_channels=8, node_heads=n_heads)
 
         # Normalization
@@ -28,7 +28,7 @@ class Pinnacle(nn.Module):
         self.batch_norm1 = BatchNorm(self.layer2_in)
 
         # Complete layer #2
-        self.conv2_up = PCTConv(self.layer2_in, num_ppi_relations, num_mg_relations, ppi_data, self.layer2_out, sem_att_channels=8, pc_att_channels=pc_att_channels, node_heads=n_heads)
+        self.conv2_up = PCTConv(self.layer2_in, num_ppi_relations, num_mg_relations, ppi_data, self.layer2_out, sem_att_channels=8, pc_att_channels=pc_att_channels, node_heads=n_heads, tissue_update=tissue_update, tissue_tol=tissue_tol)
         self.conv2_down = PPIConv(self.layer2_out * n_heads, num_ppi_relations, self.layer2_out, ppi_data, sem_att_channels=8, node_heads=n_heads)
 
         # Metagraph decoder
@@ -36,8 +36,11 @@ class Pinnacle(nn.Module):
         nn.init.xavier_uniform_(self.mg_relw, gain = nn.init.calculate_gain('leaky_relu'))
 
 
-    def forward(self, ppi_x, mg_x, ppi_metapaths, mg_metapaths, ppi_edge_index, mg_edge_index, tissue_neighbors):
+    def forward(self, ppi_x, mg_x, ppi_metapaths, mg_metapaths, ppi_edge_index, mg_edge_index, tissue_neighbors, ppi_feat):
         
+        # Gather the features of the proteins in the batch (ppi_feat is the protein feature table shared by all PPI layers; it is kept out of the model so that checkpoints and copies of the model do not hold it)
+        ppi_x = {celltype: ppi_feat[x_index] for celltype, x_index in ppi_x.items()}
+
         ########################################
         # Complete layer #1
         ########################################
@@ -0,0 +1,52 @@
+import numpy as np
+
+
+class NodeVocab:
+    """
+    Vocabulary of protein names in the global PPI network. The id of a protein is its position in the global node order, which is also its row in the feature matrix.
+
+    :param names: Protein names in global node order.
+    """
+    def __init__(self, names):
+        self.names = np.asarray(names, dtype=str)
+        self.order = np.argsort(self.names, kind="stable")
+        self.sorted_names = self.names[self.order]
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, names) -> np.ndarray:
+        """
+        Map protein names to their global ids in one vectorized lookup.
+
+        :param names: Array-like of protein names, all of which must be in the vocabulary.
+
+        :return: int64 array of global ids (same shape as :code:`names`).
+        """
+        names = np.asarray(names, dtype=str)
+        pos = np.searchsorted(self.sorted_names, names)
+        pos = np.minimum(pos, len(self.sorted_names) - 1)
+        found = self.sorted_names[pos] == names
+        assert found.all(), "Proteins missing from the global PPI: %s" % names[~found][:10].tolist()
+        return self.order[pos].astype(np.int64)
+
+    def save(self, f: str, context_ids: dict):
+        """
+        Save the vocabulary with the global ids of every context's nodes, so that downstream jobs reuse the same ids instead of matching on names.
+
+        :param f: Output :code:`.npz` file.
+        :param context_ids: Dictionary of context name to the global ids of its nodes (node :code:`i` of the context is protein :code:`ids[i]`).
+        """
+        contexts = sorted(context_ids)
+        np.savez(f, names=self.names, contexts=np.asarray(contexts, dtype=str), **{"ids_%d" % i: np.asarray(context_ids[c], dtype=np.int32) for i, c in enumerate(contexts)})
+
+
+def load_node_ids(f: str) -> tuple:
+    """
+    Load a vocabulary saved by :code:`NodeVocab.save`.
+
+    :return: :class:`NodeVocab` and a dictionary of context name to the global ids of its nodes.
+    """
+    data = np.load(f)
+    context_ids = {c: data["ids_%d" % i] for i, c in enumerate(data["contexts"].tolist())}
+    return NodeVocab(data["names"]), context_ids
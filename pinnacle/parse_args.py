@@ -10,9 +10,27 @@ def get_args():
     parser.add_argument("--mg_f", type=str, default="../data/networks/mg_edgelist.txt", help="Directory to metagraph")
     parser.add_argument("--epochs", type=int, default=300, help="Number of epochs to train")
     parser.add_argument("--resume_run", type=str, default="", help="Model hyperparameters")
+    parser.add_argument("--cache_dir", type=str, default="", help="Directory to cache parsed input networks (disabled if empty)")
+    parser.add_argument("--load_workers", type=int, default=1, help="Number of processes for reading PPI layers")
+    parser.add_argument("--contexts", type=str, default="", help="Comma-separated list of contexts to load (default: all)")
+    parser.add_argument("--num_contexts", type=int, default=0, help="Number of contexts to load, in sorted order (default: all)")
+    parser.add_argument("--split_manifest", type=str, default="", help="Split manifest to reuse (default: <resume_run>_splits.npz when resuming, if it exists; fresh runs draw new splits)")
     
     # Parameters
-    parser.add_argument("--loader", type=str, default="graphsaint", choices=["neighbor", "graphsaint"], help="Loader for minibatching.")
+    parser.add_argument("--loader", type=str, default="graphsaint", choices=["neighbor", "graphsaint", "cluster"], help="Loader for minibatching.")
+    parser.add_argument("--saint_sampler", type=str, default="edge", choices=["edge", "node", "random_walk"], help="GraphSAINT sampler (batch_size counts sampled edges, nodes, or walk roots, respectively)")
+    parser.add_argument("--saint_num_steps", type=int, default=16, help="Number of GraphSAINT batches per epoch")
+    parser.add_argument("--saint_walk_length", type=int, default=2, help="Walk length of the random_walk GraphSAINT sampler")
+    parser.add_argument("--fanouts", type=str, default="", help="Comma-separated number of neighbors sampled per hop by the neighbor loader, one per model layer, e.g., 25,10 (-1: all neighbors; default: all neighbors for 2 hops)")
+    parser.add_argument("--node_budget", type=int, default=0, help="Maximum number of nodes per batch of the neighbor loader; batches are trimmed to it after sampling, keeping the seeds and the nearest hops (0: no budget)")
+    parser.add_argument("--cluster_size", type=int, default=128, help="Target number of nodes per partition of the cluster loader")
+    parser.add_argument("--clusters_per_batch", type=int, default=4, help="Maximum number of partitions per batch of the cluster loader")
+    parser.add_argument("--contexts_per_step", type=int, default=0, help="Number of contexts drawn per training step (0: all contexts in every step)")
+    parser.add_argument("--context_sampling", type=str, default="uniform", choices=["uniform", "size", "loss"], help="Probabilities of drawing a context: uniform, proportional to its number of train edges, or proportional to its running link prediction loss")
+    parser.add_argument("--context_window", type=int, default=0, help="Every context is trained at least once every context_window steps (default: 2 * number of contexts / contexts_per_step); an epoch runs at least context_window steps, so every context is trained in every epoch")
+    parser.add_argument("--prefetch", type=int, default=0, help="Number of training batches to sample and assemble ahead in a background thread (0: no prefetching)")
+    parser.add_argument("--prefetch_workers", type=int, default=1, help="Number of threads sampling the batches of different contexts in parallel when prefetching")
+    parser.add_argument("--true_negatives", action="store_true", help="Redraw negative edges that are edges of the graph in any split (either direction).")
 
     # Hyperparameters
     parser.add_argument("--feat_mat", type=int, default=2048, help="Random Gaussian vectors of shape (1 x 2048)")
@@ -28,6 +46,8 @@ def get_args():
     parser.add_argument("--batch_size", type=int, default=64, help="Batch size")
     parser.add_argument("--norm", type=str, default=None, help="Type of normalization layer to use in up-pooling")
     parser.add_argument("--pc_att_channels", type=int, default=8, help="Type of normalization layer to use in up-pooling")
+    parser.add_argument("--tissue_update", type=int, default=100, help="Number of updates of the tissue embeddings (mean of their neighbors) per layer")
+    parser.add_argument("--tissue_tol", type=float, default=0.0, help="Stop the tissue embedding updates once no tissue embedding changes by more than this (0: run all updates)")
     
     # Save
     parser.add_argument('--save_prefix', type=str, default='../data/pinnacle_embeds/pinnacle', help='Prefix of all saved files')
@@ -54,6 +74,8 @@ def get_hparams(args):
                'lr_cent': args.lr_cent,
                'loss_type': "BCE",
                'plot': args.plot,
+               'tissue_update': args.tissue_update,
+               'tissue_tol': args.tissue_tol,
               }
     print("Hyperparameters:", hparams)    
 
@@ -0,0 +1,74 @@
+"""
+Balanced node partitions of PPI layers for the :code:`cluster` loader.
+
+Nodes are laid out in reverse Cuthill-McKee order (neighbors end up close to each other), cut into equally sized chunks, and refined with size-constrained label propagation: in every round, nodes move to the partition holding most of their neighbors, as long as that partition stays below its capacity. Partitions are computed once per context and cached on disk (see :code:`input_cache`).
+"""
+import hashlib
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+import input_cache
+
+
+PARTITION_VERSION = 1 # Bump when the partitioning changes
+
+
+def partition_graph(edge_index: np.ndarray, num_nodes: int, num_parts: int, rounds: int = 8, imbalance: float = 0.1) -> np.ndarray:
+    """
+    :param edge_index: (2, E) edges of the graph (treated as undirected).
+    :param num_nodes: Number of nodes.
+    :param num_parts: Number of partitions.
+    :param rounds: Maximum number of label propagation rounds.
+    :param imbalance: Allowed excess of a partition's size over :code:`num_nodes / num_parts`.
+
+    :return: Partition of every node, numbered consecutively from 0.
+    """
+    edge_index = np.asarray(edge_index, dtype=np.int64).reshape(2, -1)
+    if num_parts <= 1 or num_nodes == 0: return np.zeros(num_nodes, dtype=np.int64)
+    num_parts = min(num_parts, num_nodes)
+    adj = sp.coo_matrix((np.ones(edge_index.shape[1]), (edge_index[0], edge_index[1])), shape=(num_nodes, num_nodes)).tocsr()
+    adj = (adj + adj.T).tocsr()
+
+    # Contiguous chunks of a bandwidth-reducing node order
+    order = reverse_cuthill_mckee(adj, symmetric_mode=True)
+    parts = np.empty(num_nodes, dtype=np.int64)
+    parts[order] = np.arange(num_nodes) * num_parts // num_nodes
+    capacity = int(np.ceil((1 + imbalance) * num_nodes / num_parts))
+
+    nodes = np.arange(num_nodes)
+    for _ in range(rounds):
+        counts = (adj @ sp.csr_matrix((np.ones(num_nodes), (nodes, parts)), shape=(num_nodes, num_parts))).tocsr() # Neighbors of every node in every partition
+        best = np.asarray(counts.argmax(axis=1)).ravel()
+        gain = counts.max(axis=1).toarray().ravel() - np.asarray(counts[nodes, parts]).ravel()
+        movers = np.flatnonzero(gain > 0)
+        if len(movers) == 0: break
+
+        # Accept moves by decreasing gain, up to the free capacity of the target partition
+        movers = movers[np.lexsort((-gain[movers], best[movers]))]
+        targets = best[movers]
+        rank = np.arange(len(movers)) - np.searchsorted(targets, targets)
+        accept = rank < (capacity - np.bincount(parts, minlength=num_parts))[targets]
+        if not accept.any(): break
+        parts[movers[accept]] = targets[accept]
+
+    _, parts = np.unique(parts, return_inverse=True) # Drop emptied partitions
+    return parts.astype(np.int64)
+
+
+def load_partition(edge_index: np.ndarray, num_nodes: int, num_parts: int, cache_dir: str = None, name: str = "partition") -> np.ndarray:
+    """
+    Partition a graph (see :code:`partition_graph`), going through the cache if :code:`cache_dir` is set.
+
+    :param name: Name of the cache entry (unique per graph, e.g., :code:`partition_<context>`).
+    """
+    edge_index = np.ascontiguousarray(np.asarray(edge_index, dtype=np.int64).reshape(2, -1))
+    if not cache_dir: return partition_graph(edge_index, num_nodes, num_parts)
+    h = hashlib.sha1()
+    h.update(("v%d\n%d %d\n" % (PARTITION_VERSION, num_nodes, num_parts)).encode())
+    h.update(edge_index.tobytes())
+    digest = h.hexdigest()
+    arrays = input_cache.load_entry(cache_dir, name, digest)
+    if arrays is None:
+        arrays = input_cache.save_entry(cache_dir, name, digest, {"parts": partition_graph(edge_index, num_nodes, num_parts)})
+    return np.asarray(arrays["parts"])
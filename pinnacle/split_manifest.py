@@ -0,0 +1,49 @@
+"""
+Split manifest of a run: the train/val/test edges of every PPI layer and the train/val/test nodes of the center loss, stored as int32 index arrays in one :code:`.npz` file. Resumed runs and evaluation jobs load it instead of drawing new splits.
+"""
+import numpy as np
+import torch
+
+
+SPLITS = ["train", "val", "test"]
+
+
+def mask_to_index(mask) -> np.ndarray:
+    return np.flatnonzero(np.asarray(mask)).astype(np.int32)
+
+
+def index_to_mask(idx, size: int) -> torch.Tensor:
+    mask = torch.zeros(size, dtype=torch.bool)
+    mask[torch.from_numpy(np.asarray(idx, dtype=np.int64))] = True
+    return mask
+
+
+def save_split_manifest(f: str, edge_masks: dict, center_loss_idx: tuple):
+    """
+    :param f: Output :code:`.npz` file.
+    :param edge_masks: Dictionary of context name to its (train, val, test) edge masks.
+    :param center_loss_idx: (train, val, test) indices of the center loss nodes.
+    """
+    contexts = sorted(edge_masks)
+    arrays = {"contexts": np.asarray(contexts, dtype=str), "num_edges": np.asarray([len(edge_masks[c][0]) for c in contexts], dtype=np.int64)}
+    for i, c in enumerate(contexts):
+        for split, mask in zip(SPLITS, edge_masks[c]):
+            arrays["edges_%d_%s" % (i, split)] = mask_to_index(mask)
+    for split, idx in zip(SPLITS, center_loss_idx):
+        arrays["center_loss_%s" % split] = np.sort(np.asarray(idx, dtype=np.int32))
+    np.savez(f, **arrays)
+    print("Saved split manifest at %s" % f)
+
+
+def load_split_manifest(f: str) -> tuple:
+    """
+    :return: Dictionary of context name to its (train, val, test) edge indices, and the (train, val, test) indices of the center loss nodes.
+    """
+    data = np.load(f)
+    edge_splits = dict()
+    for i, (c, num_edges) in enumerate(zip(data["contexts"].tolist(), data["num_edges"].tolist())):
+        edge_splits[c] = tuple(data["edges_%d_%s" % (i, split)] for split in SPLITS)
+        assert sum(len(idx) for idx in edge_splits[c]) == num_edges, c
+    center_loss_idx = tuple(data["center_loss_%s" % split] for split in SPLITS)
+    print("Loaded split manifest from %s" % f)
+    return edge_splits, center_loss_idx
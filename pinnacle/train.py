@@ -19,7 +19,11 @@ from center_loss import CenterLoss
 import wandb
 
 # Own code
-from generate_input import read_data, get_metapaths, get_centerloss_labels
+from generate_input import read_data, get_metapaths, get_centerloss_labels, loading_pool
+from split_manifest import load_split_manifest, save_split_manifest
+from load_report import LoadReport
+from context_scheduler import ContextScheduler
+from conv import convert_ppi_convs
 import model as mdl
 import utils
 import minibatch_utils as mb_utils
@@ -39,6 +43,7 @@ torch.backends.cudnn.deterministic = True
 # Setup
 args = get_args()
 hparams_raw = get_hparams(args)
+load_pool = loading_pool(args.load_workers) if args.load_workers > 1 else None # Forked before torch and wandb start any threads
 
 save_log = args.save_prefix + "_gnn_train.log"
 save_graph = args.save_prefix + "_graph.pkl"
@@ -47,6 +52,9 @@ save_plots = args.save_prefix + "_train_embed_plots.pdf"
 save_ppi_embed = args.save_prefix + "_protein_embed.pth"
 save_mg_embed = args.save_prefix + "_mg_embed.pth"
 save_labels_dict = args.save_prefix + "_labels_dict.txt"
+save_protein_ids = args.save_prefix + "_protein_ids.npz"
+save_splits = args.save_prefix + "_splits.npz"
+save_load_report = args.save_prefix + "_load_report.json"
 
 log_f = open(save_log, "w")
 log_f.write("Number of epochs: %s \n" % args.epochs)
@@ -65,37 +73,65 @@ wandb.init(config = hparams_raw, project = "pinnacle", entity = "user")
 
 hparams = wandb.config
 
-# Read data
-ppi_data, mg_data, edge_attr_dict, celltype_map, tissue_neighbors, ppi_layers, metagraph = read_data(args.G_f, args.ppi_dir, args.mg_f, hparams['feat_mat'])
+# Reuse the splits of a resumed run (if saved), or of an explicitly given manifest; fresh runs draw new splits
+split_manifest = args.split_manifest if args.split_manifest != "" else (args.resume_run + "_splits.npz" if args.resume_run != "" else "")
+edge_splits, center_loss_idx = load_split_manifest(split_manifest) if args.split_manifest != "" or os.path.exists(split_manifest) else (None, None)
+
+# Read data (optionally only a subset of contexts)
+contexts = args.contexts.split(",") if args.contexts != "" else (args.num_contexts if args.num_contexts > 0 else None)
+load_report = LoadReport()
+ppi_data, mg_data, edge_attr_dict, celltype_map, tissue_neighbors, ppi_layers, metagraph, node_vocab, feat_mat = read_data(args.G_f, args.ppi_dir, args.mg_f, hparams['feat_mat'], args.cache_dir, args.load_workers, edge_splits, contexts, load_report, load_pool)
+if load_pool is not None: load_pool.shutdown()
+ppi_feat = feat_mat.to(device) # Protein features shared by all PPI layers (passed to the model rather than stored in it, so that checkpoints do not hold them)
+load_report.log(log_f)
+load_report.save(save_load_report)
+node_vocab.save(save_protein_ids, {c: ppi_data[i].global_id.numpy() for c, i in celltype_map.items() if i in ppi_data})
 ppi_metapaths, mg_metapaths = get_metapaths()
-center_loss_labels, train_mask, val_mask, test_mask = get_centerloss_labels(args, celltype_map, ppi_layers)
+center_loss_labels, train_mask, val_mask, test_mask = get_centerloss_labels(args, celltype_map, ppi_layers, center_loss_idx)
+if edge_splits is None or split_manifest != save_splits:
+    save_split_manifest(save_splits, {c: (ppi_data[i].train_mask, ppi_data[i].val_mask, ppi_data[i].test_mask) for c, i in celltype_map.items() if i in ppi_data}, (train_mask, val_mask, test_mask))
+
+# GraphSAINT loader options
+saint_args = {"sampler": args.saint_sampler, "num_steps": args.saint_num_steps, "walk_length": args.saint_walk_length}
+
+# Cluster loader options (partitions are cached per context)
+cluster_args = {"cluster_size": args.cluster_size, "parts_per_batch": args.clusters_per_batch, "save_dir": os.path.join(args.cache_dir, "partitions") if args.cache_dir else None}
+
+# Neighbor loader options
+neighbor_args = {"fanouts": [int(f) for f in args.fanouts.split(",")] if args.fanouts else None, "node_budget": args.node_budget}
+
+# Batch generators (positive edges, labels, metapath adjacencies, and features are built once; only negatives are resampled every epoch)
+ppi_train_batches = mb_utils.BatchGenerator(ppi_data, ppi_metapaths, edge_attr_dict, "train", args.batch_size, device, ppi=True, loader_type=args.loader, true_negatives=args.true_negatives, saint_args=saint_args, cluster_args=cluster_args, neighbor_args=neighbor_args)
+ppi_val_batches = mb_utils.BatchGenerator(ppi_data, ppi_metapaths, edge_attr_dict, "val", args.batch_size, device, ppi=True, loader_type=args.loader, true_negatives=args.true_negatives, saint_args=saint_args, cluster_args=cluster_args, neighbor_args=neighbor_args)
+mg_train_batches = mb_utils.BatchGenerator({0: mg_data}, mg_metapaths, edge_attr_dict, "train", args.batch_size, device, ppi=False, loader_type=args.loader, true_negatives=args.true_negatives)
+mg_val_batches = mb_utils.BatchGenerator({0: mg_data}, mg_metapaths, edge_attr_dict, "val", args.batch_size, device, ppi=False, loader_type=args.loader, true_negatives=args.true_negatives)
+ppi_metapaths_train_device = {key: [val[0].to(device)] for key, val in ppi_train_batches.metapath_adjs_dict.items()}
+mg_metapaths_train_device = [val.to(device) for val in mg_train_batches.metapath_adjs_dict[0]]
+context_scheduler = ContextScheduler(list(ppi_data.keys()), args.contexts_per_step, args.context_sampling, {key: ppi_train_batches.pos_edge_index[key].shape[1] for key in ppi_data}, args.context_window) if args.contexts_per_step > 0 else None # Contexts trained in every step (all, if not set)
+center_loss_mask = mb_utils.CenterLossMask(train_mask, ppi_train_batches.x_dict, device) # Center loss train mask over the concatenated nodes of all cell types
 
 def train(epoch, model, optimizer, center_loss):
 
     global args, ppi_data, mg_data, best_model, best_val_acc, hparams
 
-    # Generate PPI batches
-    ppi_train_loader_dict, _, ppi_metapaths_train, ppi_x_ori = mb_utils.generate_batch(ppi_data, ppi_metapaths, edge_attr_dict, "train", args.batch_size, device, ppi=True, loader_type=args.loader)
-    ppi_val_loader_dict, _, ppi_metapaths_val, _ = mb_utils.generate_batch(ppi_data, ppi_metapaths, edge_attr_dict, "val", args.batch_size, device, ppi=True, loader_type=args.loader)
+    # Generate PPI batches (resample negatives)
+    ppi_train_loader_dict, _, ppi_metapaths_train, ppi_x_ori = ppi_train_batches.resample()
+    ppi_val_loader_dict, _, ppi_metapaths_val, _ = ppi_val_batches.resample()
     
-    # Generate metagraph batches
-    _, mg_data_train, mg_metapaths_train, mg_x_ori = mb_utils.generate_batch({0: mg_data}, mg_metapaths, edge_attr_dict, "train", args.batch_size, device, ppi=False, loader_type=args.loader)
-    _, mg_data_val, mg_metapaths_val, _ = mb_utils.generate_batch({0: mg_data}, mg_metapaths, edge_attr_dict, "val", args.batch_size, device, ppi=False, loader_type=args.loader)
+    # Generate metagraph batches (resample negatives)
+    _, mg_data_train, mg_metapaths_train, mg_x_ori = mg_train_batches.resample()
+    _, mg_data_val, mg_metapaths_val, _ = mg_val_batches.resample()
 
     mg_x_ori = mg_x_ori[0]
     mg_data_train = mg_data_train[0]
     mg_data_val = mg_data_val[0]
     mg_metapaths_train = mg_metapaths_train[0]
     mg_metapaths_val = mg_metapaths_val[0]
-    for i, val in enumerate(mg_metapaths_train):
-        mg_metapaths_train[i] = val.to(device)
-    for key, val in ppi_metapaths_train.items():
-        ppi_metapaths_train[key] = [val[0].to(device)]
     
     model.train()
     
     # Run batch training
-    _, _, mg_pred, ppi_preds_all, ppi_data_train_y, loss = mb_utils.iterate_train_batch(ppi_train_loader_dict, ppi_x_ori, ppi_metapaths, mg_x_ori, mg_metapaths_train, mg_data_train, tissue_neighbors, model, hparams, device, wandb, center_loss, optimizer, train_mask)
+    _, _, mg_pred, ppi_preds_all, ppi_data_train_y, loss = mb_utils.iterate_train_batch(ppi_train_loader_dict, ppi_x_ori, ppi_feat, ppi_metapaths, mg_x_ori, mg_metapaths_train_device, mg_data_train, tissue_neighbors, model, hparams, device, wandb, center_loss, optimizer, center_loss_mask, args.prefetch, args.prefetch_workers, context_scheduler)
     # ppi_x_ori, mg_x_ori, mg_pred, ppi_preds_all, ppi_data_train_y, loss = utils.iterate_train_batch(ppi_train_loader_dict, ppi_x_ori, ppi_metapaths, mg_x_ori, mg_metapaths_train, mg_data_train, tissue_neighbors, model, hparams, device, wandb, center_loss, optimizer, train_mask)
 
     # Training metrics
@@ -106,7 +142,7 @@ def train(epoch, model, optimizer, center_loss):
     utils.metrics_per_rel(mg_pred, mg_data_train, ppi_preds_all, ppi_data_train_y, edge_attr_dict, celltype_map, log_f, wandb, "train")
 
     # Validation set predictions
-    ppi_x, _, mg_pred, ppi_preds_all, ppi_data_val_y = mb_utils.iterate_predict_batch(ppi_val_loader_dict, ppi_x_ori, ppi_metapaths_train, mg_x_ori, mg_metapaths_train, mg_data_val, tissue_neighbors, model, hparams, device)  # Using train metapaths.
+    ppi_x, _, mg_pred, ppi_preds_all, ppi_data_val_y = mb_utils.iterate_predict_batch(ppi_val_loader_dict, ppi_x_ori, ppi_feat, ppi_metapaths_train_device, mg_x_ori, mg_metapaths_train_device, mg_data_val, tissue_neighbors, model, hparams, device)  # Using train metapaths.
     
     # Validation metrics
     roc_score, ap_score, val_acc, val_f1 = utils.calc_metrics(mg_pred, mg_data_val, ppi_preds_all, ppi_data_val_y)
@@ -133,11 +169,6 @@ def train(epoch, model, optimizer, center_loss):
             torch.save({"epoch": epoch, "model": model, "optimizer": optimizer}, f)
         best_model = copy.deepcopy(model)
     
-    for i, val in enumerate(mg_metapaths_train):
-        mg_metapaths_train[i] = val.detach().cpu()
-    for key, val in ppi_metapaths_train.items():
-        ppi_metapaths_train[key] = [val[0].detach().cpu()]
-    
     return ppi_metapaths_train, mg_metapaths_train, ppi_metapaths_val, mg_metapaths_val
 
 
@@ -148,14 +179,14 @@ def test(model, ppi_metapaths_test, mg_metapaths_test):
     model.eval()
     
     # Generate PPI batches
-    ppi_test_loader_dict, _, _, ppi_x = mb_utils.generate_batch(ppi_data, ppi_metapaths, edge_attr_dict, "test", args.batch_size, device, ppi=True, loader_type=args.loader)
+    ppi_test_loader_dict, _, _, ppi_x = mb_utils.generate_batch(ppi_data, ppi_metapaths, edge_attr_dict, "test", args.batch_size, device, ppi=True, loader_type=args.loader, true_negatives=args.true_negatives, saint_args=saint_args, cluster_args=cluster_args, neighbor_args=neighbor_args)
     
     # Generate metagraph batches
-    _, mg_data_test, _, mg_x = mb_utils.generate_batch({0: mg_data}, mg_metapaths, edge_attr_dict, "test", args.batch_size, device, ppi=False, loader_type=args.loader)
+    _, mg_data_test, _, mg_x = mb_utils.generate_batch({0: mg_data}, mg_metapaths, edge_attr_dict, "test", args.batch_size, device, ppi=False, loader_type=args.loader, true_negatives=args.true_negatives)
     mg_data_test = mg_data_test[0]
     mg_x = mg_x[0]
 
-    _, _, mg_pred, ppi_preds_all, ppi_data_test_y = mb_utils.iterate_predict_batch(ppi_test_loader_dict, ppi_x, ppi_metapaths_test, mg_x, mg_metapaths_test, mg_data_test, tissue_neighbors, model, hparams, device)
+    _, _, mg_pred, ppi_preds_all, ppi_data_test_y = mb_utils.iterate_predict_batch(ppi_test_loader_dict, ppi_x, ppi_feat, ppi_metapaths_test, mg_x, mg_metapaths_test, mg_data_test, tissue_neighbors, model, hparams, device)
 
     roc_score, ap_score, test_acc, test_f1 = utils.calc_metrics(mg_pred, mg_data_test, ppi_preds_all, ppi_data_test_y)
     
@@ -183,12 +214,15 @@ def main():
         checkpoint = torch.load(save_model)
         model = checkpoint["model"]
         optimizer = checkpoint["optimizer"]
+        if convert_ppi_convs(model): # Checkpoints saved before grouped GATv2 layers (the optimizer state refers to the replaced parameters)
+            print("Converted per cell type GATv2 layers to grouped layers, resetting the optimizer state")
+            optimizer = torch.optim.Adam(model.parameters(), lr = hparams['lr'], weight_decay = hparams['wd'])
         params = list(model.parameters())
     else:
-        model = mdl.Pinnacle(mg_data.x.shape[1], hparams['hidden'], hparams['output'], len(ppi_metapaths), len(mg_metapaths), ppi_data, hparams['n_heads'], hparams['pc_att_channels'], hparams['dropout']).to(device)
+        model = mdl.Pinnacle(mg_data.x.shape[1], hparams['hidden'], hparams['output'], len(ppi_metapaths), len(mg_metapaths), ppi_data, hparams['n_heads'], hparams['pc_att_channels'], hparams['dropout'], hparams['tissue_update'], hparams['tissue_tol']).to(device)
         params = list(model.parameters())
         optimizer = torch.optim.Adam(params, lr = hparams['lr'], weight_decay = hparams['wd'])
-    center_loss = CenterLoss(num_classes=len(set(center_loss_labels)), feat_dim=hparams['output'] * hparams['n_heads'], use_gpu=torch.cuda.is_available())
+    center_loss = CenterLoss(num_classes=len(np.unique(center_loss_labels)), feat_dim=hparams['output'] * hparams['n_heads'], use_gpu=torch.cuda.is_available())
     params += list(center_loss.parameters())
     wandb.watch(model)
     print(model)
@@ -220,7 +254,7 @@ def main():
     _, mg_data_all, mg_metapaths_adjs, mg_x = mb_utils.generate_batch({0: mg_data}, mg_metapaths, edge_attr_dict, "all", args.batch_size, device, ppi = False, loader_type=args.loader)
     
     # Generate final embeddings
-    best_ppi_x, best_mg_x = utils.get_embeddings(best_model, ppi_x, mg_x[0], ppi_metapaths_adjs, mg_metapaths_adjs[0], ppi_data_all, mg_data_all[0]["total_edge_index"], tissue_neighbors)
+    best_ppi_x, best_mg_x = utils.get_embeddings(best_model, ppi_x, mg_x[0], ppi_metapaths_adjs, mg_metapaths_adjs[0], ppi_data_all, mg_data_all[0]["total_edge_index"], tissue_neighbors, feat_mat)
 
     # Save outputs
     for celltype, x in best_ppi_x.items():
@@ -110,9 +110,9 @@ def construct_metapath(metapaths, edge_index, edge_type, num_nodes):
 
 
 @torch.no_grad()
-def get_embeddings(model, ppi_x, mg_x, ppi_metapaths, mg_metapaths, ppi_edge_index, mg_edge_index, tissue_neighbors):
+def get_embeddings(model, ppi_x, mg_x, ppi_metapaths, mg_metapaths, ppi_edge_index, mg_edge_index, tissue_neighbors, ppi_feat):
     model.eval()
-    ppi_x, mg_x = model(ppi_x, mg_x, ppi_metapaths, mg_metapaths, ppi_edge_index, mg_edge_index, tissue_neighbors)
+    ppi_x, mg_x = model(ppi_x, mg_x, ppi_metapaths, mg_metapaths, ppi_edge_index, mg_edge_index, tissue_neighbors, ppi_feat)
     return ppi_x, mg_x 
 
 
@@ -170,7 +170,7 @@ def combine_embed(ppi_embed, mg_embed, key, ppi_layers, metagraph, finetune_labe
     sanity = dict()
     for celltype, x in ppi_embed.items():
         labels_df["Cell Type"] += [key[celltype]] * x.size(0)
-        degrees = [ppi_layers[key[celltype]].degree[n] for n in ppi_layers[key[celltype]].nodes]
+        degrees = ppi_layers[key[celltype]].degree().tolist()
         labels_df["Degree"] += degrees
         labels_df["Relative Degree"] += [round(d / max(degrees), 5) for d in degrees]
         labels_df["Name"] += list(ppi_layers[key[celltype]].nodes)
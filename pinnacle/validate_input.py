@@ -0,0 +1,39 @@
+"""
+Connectivity checks for the input networks. All PPI layers are checked before reporting, so one run lists every disconnected context.
+"""
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+
+def num_components(indptr: np.ndarray, indices: np.ndarray, num_nodes: int) -> int:
+    """
+    Number of connected components of an undirected graph given as a CSR adjacency.
+    """
+    if num_nodes == 0: return 0
+    adj = sp.csr_matrix((np.ones(len(indices), dtype=np.int8), np.asarray(indices), np.asarray(indptr)), shape=(num_nodes, num_nodes))
+    n, _ = connected_components(adj, directed=False)
+    return n
+
+
+def check_ppi_layers(ppi_layers: dict):
+    """
+    Check that every PPI layer is connected. The checks run in-process: scipy's connected components take milliseconds per layer, less than sending a layer's CSR arrays to a worker process.
+
+    :param ppi_layers: Dictionary of context to :class:`PPILayer`.
+    """
+    contexts = list(ppi_layers)
+    counts = [num_components(ppi_layers[c].indptr, ppi_layers[c].indices, len(ppi_layers[c])) for c in contexts]
+
+    failed = {c: n for c, n in zip(contexts, counts) if n != 1}
+    assert len(failed) == 0, "%d PPI layers are not connected (context: number of components): %s" % (len(failed), failed)
+
+
+def check_metagraph(edge_index: np.ndarray, num_nodes: int):
+    """
+    Check that the metagraph is (weakly) connected.
+    """
+    edge_index = np.asarray(edge_index)
+    adj = sp.coo_matrix((np.ones(edge_index.shape[1], dtype=np.int8), (edge_index[0], edge_index[1])), shape=(num_nodes, num_nodes))
+    n, labels = connected_components(adj, directed=False)
+    assert n == 1, "Metagraph has %d connected components (sizes: %s)" % (n, np.bincount(labels).tolist())